@@ -2,6 +2,7 @@ import logging
 import pickle
 import copy
 import datetime
+import hashlib
 try:
     from google.appengine.ext.db import djangoforms
 except ImportError:
@@ -17,6 +18,9 @@ except ImportError:
 from django.utils.translation import gettext as _
 
 from . import admin_widgets
+from . import caching
+from . import db_extensions
+from . import search
 from . import utils
 from . import admin_settings
 
@@ -28,14 +32,21 @@ class AdminModelForm(djangoforms.ModelForm):
         to the form while processing the request.
     """
     enctype = ''
+    # Fields indexed for full-text search (set from ModelAdmin.searchFields)
+    searchFields = ()
     def __init__(self, urlPrefix = '', *args, **kwargs):
         super(AdminModelForm, self).__init__(*args, **kwargs)
         self.urlPrefix = urlPrefix
         instance = kwargs.get('instance', None)
 
         for fieldName, field in self.fields.items():
+            # Fields of base_fields are shared by concurrent requests, older Django
+            # versions do not copy them. Request state is set on copies only.
+            field = copy.copy(field)
+            field.widget = copy.copy(field.widget)
+            self.fields[fieldName] = field
             # expose urlPrefix to Select widget
-            if isinstance(field.widget, admin_widgets.ReferenceSelect):
+            if isinstance(field.widget, (admin_widgets.ReferenceSelect, admin_widgets.SelectMultiple)):
                 field.widget.urlPrefix = self.urlPrefix
             # deliver meta info to FileInput widget for file download link display
             # do it only if file is uploaded :)
@@ -45,11 +56,7 @@ class AdminModelForm(djangoforms.ModelForm):
                     fileName = meta['File_Name']
                 else:
                     fileName = ''
-                # these settings should be indivudual for every instance
-                field = copy.copy(field)
-                widget = copy.copy(field.widget)
-                field.widget = widget
-                self.fields[fieldName] = field
+                widget = field.widget
                 # set uploaded file meta data
                 widget.showDownloadLink = True
                 widget.urlPrefix = self.urlPrefix
@@ -58,10 +65,14 @@ class AdminModelForm(djangoforms.ModelForm):
                 widget.itemKey = instance.key()
                 widget.fileName = fileName
 
-    def save(self, *args, **kwargs):
-        """The overrided method adds uploaded file meta info for BlobProperty fields.
+    def save(self, commit = True):
+        """The overrided method adds uploaded file meta info for BlobProperty fields
+            and stores uploads of ChunkedBlobProperty fields.
+            Saved item is indexed for full-text search by searchFields;
+            with commit = False the caller indexes the item after saving it.
         """
-        item = super(AdminModelForm, self).save(*args, **kwargs)
+        replacedBlobIds = self._saveChunkedUploads()
+        item = super(AdminModelForm, self).save(commit = False)
         for fieldName, field in self.fields.items():
             if isinstance(field, FileField) and field.file_name is not None:
                 metaFieldName = fieldName + BLOB_FIELD_META_SUFFIX
@@ -70,7 +81,12 @@ class AdminModelForm(djangoforms.ModelForm):
                         'Content_Type': field.file_type,
                         'File_Name': field.file_name,
                         'File_Size': field.file_size,
+                        'Content_Hash': field.file_hash,
+                        'Upload_Date': datetime.datetime.utcnow(),
                     }
+                    if isinstance(field, ChunkedFileField):
+                        metaData['Chunk_Count'] = field.chunk_count
+                        metaData['Chunk_Size'] = admin_settings.ADMIN_BLOB_CHUNK_SIZE
                     logging.info("Caching meta data for BlobProperty: %r" % metaData)
                     setattr(item, metaFieldName, pickle.dumps(metaData))
                 else:
@@ -79,16 +95,34 @@ class AdminModelForm(djangoforms.ModelForm):
                         {'metaFieldName': metaFieldName, 'propertyName' : fieldName, 'modelName': self.Meta.model.kind()}
                     )
         # Save the item in Datastore if not told otherwise.
-        if kwargs.get('commit', True):
+        if commit:
             item.put()
+            # Replaced chunked blobs are not referenced any more
+            for blobId in replacedBlobIds:
+                db_extensions.deleteBlobChunks(blobId)
+            search.indexItems(self.searchFields, [item])
         return item
 
+    def _saveChunkedUploads(self):
+        """Stores uploaded files of ChunkedBlobProperty fields.
+            Returns ids of blobs that are replaced by the uploads.
+        """
+        replacedBlobIds = []
+        for fieldName, field in self.fields.items():
+            if isinstance(field, ChunkedFileField) and field.upload is not None:
+                field.chunk_count = db_extensions.putBlobChunks(field.upload.blobId, field.upload.chunks())
+                if self.instance is not None and getattr(self.instance, fieldName):
+                    replacedBlobIds.append(getattr(self.instance, fieldName))
+        return replacedBlobIds
 
 
-def createAdminForm(formModel, editFields, editProps):
+
+def createAdminForm(formModel, editFields, editProps, lookupFields = ()):
     """AdminForm factory
         Input: formModel - model that will be used for ModelForm creation
             editFields - tuple of field names that should be exposed in the form
+            lookupFields - names of reference fields whose choices are
+                searched on demand instead of being rendered all at once
     """
     class AdminForm(AdminModelForm):
         class Meta:
@@ -110,11 +144,18 @@ def createAdminForm(formModel, editFields, editProps):
             field.widget = admin_widgets.ReferenceSelect(
                 attrs = field.widget.attrs,
                 urlPrefix = None,
-                referenceKind = getattr(formModel, fieldName).reference_class.kind()
+                referenceKind = getattr(formModel, fieldName).reference_class.kind(),
+                emptyLabel = field.empty_label
             )
             # Choices must be set after creating the widget because in our case choices
             # is not a list but a wrapeper around query that always fetches fresh data from datastore
             field.widget.choices = field.choices
+        if isinstance(field, ModelMultipleChoiceField):
+            field.lookup = fieldName in lookupFields
+        if fieldName in lookupFields:
+            logging.info("  Lazy loading choices of field: %s" % fieldName)
+            field.widget.lookupModel = formModel.kind()
+            field.widget.lookupField = fieldName
         if getattr(field.widget, 'needs_multipart_form', False):
             AdminForm.enctype = 'multipart/form-data'
 
@@ -150,6 +191,7 @@ class FileField(forms.fields.Field):
         self.file_name = None
         self.file_size = None
         self.file_type = None
+        self.file_hash = None
         self.__args = args
         self.__kwargs = kwargs
 
@@ -180,10 +222,78 @@ class FileField(forms.fields.Field):
         if self.file_size > MAX_BLOB_SIZE:
             raise ValidationError(self.error_messages['max_size'] % (self.file_size, MAX_BLOB_SIZE))
 
+        self.file_hash = utils.blobHash(file_content)
         return file_content
 forms.fields.FileField = FileField
 forms.FileField = FileField
 
+
+class ChunkedUpload(object):
+    """Uploaded file of ChunkedBlobProperty field that is not stored yet.
+        File is read chunk by chunk so it is never copied to memory as a whole.
+    """
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.blobId = db_extensions.ChunkedBlobProperty.newBlobId()
+
+    def chunks(self):
+        self.file.seek(0)
+        while True:
+            data = self.file.read(admin_settings.ADMIN_BLOB_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+class ChunkedFileField(FileField):
+    """File field for ChunkedBlobProperty.
+        clean() returns ChunkedUpload that is stored by AdminModelForm.save().
+    """
+    def __init__(self, *args, **kwargs):
+        super(ChunkedFileField, self).__init__(*args, **kwargs)
+        self.upload = None
+        self.chunk_count = None
+        self.__args = args
+        self.__kwargs = kwargs
+
+    def __copy__(self):
+        return ChunkedFileField(*self.__args, **self.__kwargs)
+
+    def clean(self, data, initial=None):
+        forms.fields.Field.clean(self, initial or data)
+
+        if not self.required and data in forms.fields.EMPTY_VALUES:
+            return None
+
+        try:
+            fileName = data.filename
+            fileType = data.type
+            upload = data.file
+            upload.seek(0, 2)
+            fileSize = upload.tell()
+        except AttributeError:
+            raise ValidationError(self.error_messages['invalid'])
+        if not fileSize and initial:
+            return initial
+
+        self.file_name = fileName
+        self.file_size = fileSize
+        self.file_type = fileType
+        if not self.file_name:
+            raise ValidationError(self.error_messages['invalid'])
+        if not self.file_size:
+            raise ValidationError(self.error_messages['empty'])
+        if self.file_size > admin_settings.MAX_CHUNKED_BLOB_SIZE:
+            raise ValidationError(self.error_messages['max_size'] % (self.file_size, admin_settings.MAX_CHUNKED_BLOB_SIZE))
+
+        self.upload = ChunkedUpload(upload, fileSize)
+        fileHash = hashlib.md5()
+        for chunk in self.upload.chunks():
+            fileHash.update(chunk)
+        self.file_hash = fileHash.hexdigest()
+        return self.upload
+
 ### HACK HACK HACK ###
 # djangoforms.ReferenceProperty.get_value_for_form() does not catch the error that occurs
 # when referenced item is deleted.
@@ -224,12 +334,16 @@ class ModelMultipleChoiceField(forms.MultipleChoiceField):
             like for forms.Field.__init__(); widget defaults to forms.SelectMultiple
         """
         assert issubclass(reference_class, db.Model)
+        # Choices of all items are shared through caching module
+        self._cache_choices = query is None
         if query is None:
             query = db.Query(reference_class)
         assert isinstance(query, db.Query)
         self.reference_class = reference_class
         self._query = query
         self._choices = choices
+        # If True choices are searched on demand and are not validated against the query
+        self.lookup = False
         super(ModelMultipleChoiceField, self).__init__(choices, required, widget, label, initial,
                 help_text, *args, **kwargs)
         self._update_widget_choices()
@@ -248,6 +362,7 @@ class ModelMultipleChoiceField(forms.MultipleChoiceField):
         As a side effect, the widget's choices are updated.
         """
         self._query = query
+        self._cache_choices = False
         self._update_widget_choices()
 
     query = property(_get_query, _set_query)
@@ -255,6 +370,10 @@ class ModelMultipleChoiceField(forms.MultipleChoiceField):
     def _generate_choices(self):
         """Generator yielding (key, label) pairs from the query results.
         """
+        if self._cache_choices:
+            for choice in caching.getChoices(self.reference_class):
+                yield choice
+            return
         for inst in self._query:
             yield (inst.key(), unicode(inst))
 
@@ -281,6 +400,8 @@ class ModelMultipleChoiceField(forms.MultipleChoiceField):
     def clean(self, value):
         """Override Field.clean() to do reference-specific value cleaning.
         """
+        if self.lookup:
+            return self._cleanLookup(value)
         value = super(ModelMultipleChoiceField, self).clean(value)
         new_value = []
         for item in value:
@@ -294,6 +415,25 @@ class ModelMultipleChoiceField(forms.MultipleChoiceField):
             new_value.append(item)
         return new_value
 
+    def _cleanLookup(self, value):
+        """Validates selected keys with a single datastore call
+            instead of iterating all choices.
+        """
+        if self.required and not value:
+            raise ValidationError(self.error_messages['required'])
+        if not value:
+            return []
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError(self.error_messages['invalid_list'])
+        try:
+            keys = [db.Key(unicode(item)) for item in value]
+        except (datastore_errors.BadKeyError, datastore_errors.BadArgumentError):
+            raise ValidationError(self.error_messages['invalid_choice'])
+        for item in db.get(keys):
+            if not isinstance(item, self.reference_class):
+                raise ValidationError(self.error_messages['invalid_choice'])
+        return keys
+
 class SplitDateTimeField(forms.fields.SplitDateTimeField):
     def compress(self, data_list):
         """Checks additionaly if all necessary data is supplied
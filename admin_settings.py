@@ -9,9 +9,89 @@ ADMIN_TEMPLATE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 't
 # Items per page in admin list view
 ADMIN_ITEMS_PER_PAGE = 50
 
+# Number of preceding page cursors kept in cursor paging tokens.
+# Pages further back are fetched using an offset.
+ADMIN_CURSOR_TRAIL = 10
+
+# Seconds to keep item count in memcache for ModelAdmin.listCount = 'memcache'
+ADMIN_COUNT_CACHE_TIME = 60
+
+# Number of shards for ModelAdmin.listCount = 'sharded'
+ADMIN_COUNTER_SHARDS = 20
+
+# Number of items handled by one datastore call in bulk actions (max 500)
+ADMIN_BULK_BATCH_SIZE = 500
+
+# Seconds a single request of a bulk action may run. Bulk action
+# continues in a new request after that.
+ADMIN_BULK_TIME_LIMIT = 20
+
+# Number of items fetched by one datastore call during export
+ADMIN_EXPORT_BATCH_SIZE = 100
+
+# Number of imported rows written by one datastore call
+ADMIN_IMPORT_BATCH_SIZE = 200
+
+# Max number of row errors shown in import report
+ADMIN_IMPORT_MAX_ERRORS = 100
+
+# Time in seconds for keeping reference field choices in memcache.
+# Choices are reloaded after items are changed through admin site anyway.
+ADMIN_CHOICES_CACHE_TIME = 3600
+
+# Number of list view rows whose referenced items are fetched at once.
+# Page query reads the whole page in one batch, so by default references
+# of the whole page are fetched with one get that runs while the page
+# around the rows is rendered. Smaller batches also overlap gets of the
+# following rows with rendering of the previous ones at the cost of more gets.
+ADMIN_LIST_ROW_BATCH = ADMIN_ITEMS_PER_PAGE
+
+# Max size in bytes of rendered list page cached by ModelAdmin.listCache
+ADMIN_LIST_CACHE_MAX_SIZE = 100 * 1024
+
+# Number of items returned by one lookup request of lazy loading reference fields
+ADMIN_LOOKUP_LIMIT = 20
+
+# Min length of words indexed for ModelAdmin.searchFields
+ADMIN_SEARCH_MIN_WORD = 2
+
+# Max number of items in search posting list of one word.
+# More common words are not used for searching.
+ADMIN_SEARCH_MAX_POSTINGS = 5000
+
+# Measure datastore RPCs and render time of admin requests (see /_stats/ page)
+ADMIN_STATS_ENABLED = True
+
+# Seconds of requests summarized on stats page
+ADMIN_STATS_WINDOW = 3600
+
+# Max number of requests per route kept for stats page
+ADMIN_STATS_MAX_SAMPLES = 1000
+
+# Log URL routing of every admin request (for debugging only)
+ADMIN_TRACE_ROUTING = False
+
 # Set by Google - currently 10MB
 # This is used for validation of file uploads.
 MAX_BLOB_SIZE = 1 * 1024 * 1024
 
+# Max size of ChunkedBlobProperty uploads.
+# App Engine limits request size to 32MB.
+MAX_CHUNKED_BLOB_SIZE = 30 * 1024 * 1024
+
+# Size of ChunkedBlobProperty chunk entities. Must stay below 1MB entity size limit.
+ADMIN_BLOB_CHUNK_SIZE = 900 * 1024
+
+# Number of ChunkedBlobProperty chunks written or read by a single datastore call.
+ADMIN_BLOB_CHUNK_BATCH = 4
+
 # Suffix for BlobProperty meta info storage.
 BLOB_FIELD_META_SUFFIX = '_meta'
+
+# Cache-Control header of BlobProperty downloads.
+# Browsers revalidate downloads with ETag/Last-Modified.
+ADMIN_BLOB_CACHE_CONTROL = 'private, no-cache'
+
+# Seconds to keep blob meta info in memcache for answering
+# revalidation requests without loading the entity.
+ADMIN_BLOB_META_CACHE_TIME = 3600
@@ -1,20 +1,84 @@
 from webob.multidict import UnicodeMultiDict
+from google.appengine.api import datastore_errors
+from google.appengine.ext import db
 try:
     from django import newforms as forms
 except ImportError:
     from django import forms
+try:
+    from django.newforms.util import flatatt
+except ImportError:
+    from django.forms.util import flatatt
+from django.utils.html import escape
+
 
-class ReferenceSelect(forms.widgets.Select):
+def _selectedChoices(values):
+    """Returns (key, label) pairs of referenced items with given keys.
+        Items are fetched with a single datastore call.
+    """
+    keys = []
+    for value in values:
+        try:
+            keys.append(db.Key(str(value)))
+        except (datastore_errors.BadKeyError, datastore_errors.BadArgumentError, UnicodeEncodeError):
+            pass
+    if not keys:
+        return []
+    return [(item.key(), unicode(item)) for item in db.get(keys) if item is not None]
+
+
+class LookupMixin(object):
+    """Lazy loading mode for reference selects.
+        If lookupField is set only currently selected options are rendered
+        and other options are searched through lookup_get view of lookupModel.
+    """
+    lookupModel = None
+    lookupField = None
+    lookup_template = (u'\n<span class="lookup">'
+        u'<input type="text" class="lookupInput" size="20" title="Type the beginning of the label"'
+        u' onkeyup="AdminLookup.search(this, \'%(selectId)s\', \'%(url)s\');"/>'
+        u' <a href="#" style="display:none;" onclick="return AdminLookup.more(\'%(selectId)s\');">More</a>'
+        u'</span>')
+
+    def lookupUrl(self):
+        return u'%s/%s/lookup/?field=%s' % (self.urlPrefix or '', self.lookupModel, self.lookupField)
+
+    def renderLookup(self, name, values, attrs, emptyChoices, multiple):
+        """Renders select with selected options only and search input.
+        """
+        finalAttrs = self.build_attrs(attrs, name = name)
+        finalAttrs.setdefault('id', 'id_%s' % name)
+        if multiple:
+            finalAttrs['multiple'] = 'multiple'
+        output = [u'<select%s>' % flatatt(finalAttrs)]
+        selected = set([unicode(value) for value in values])
+        for key, label in list(emptyChoices) + _selectedChoices(values):
+            output.append(u'<option value="%s"%s>%s</option>' % (
+                escape(unicode(key)),
+                unicode(key) in selected and u' selected="selected"' or u'',
+                escape(label)))
+        output.append(u'</select>')
+        output.append(self.lookup_template % {'selectId': finalAttrs['id'], 'url': escape(self.lookupUrl())})
+        return u'\n'.join(output)
+
+
+class ReferenceSelect(LookupMixin, forms.widgets.Select):
     """Customized Select widget that adds link "Add new" near dropdown box.
         This widget should be used for ReferenceProperty support only.
     """
-    def __init__(self, urlPrefix = '', referenceKind = '', *attrs, **kwattrs):
+    def __init__(self, urlPrefix = '', referenceKind = '', lookupModel = None, lookupField = None, emptyLabel = u'---------', *attrs, **kwattrs):
         super(ReferenceSelect, self).__init__(*attrs, **kwattrs)
         self.urlPrefix = urlPrefix
         self.referenceKind = referenceKind
-
-    def render(self, *attrs, **kwattrs):
-        output = super(ReferenceSelect, self).render(*attrs, **kwattrs)
+        self.lookupModel = lookupModel
+        self.lookupField = lookupField
+        self.emptyLabel = emptyLabel
+
+    def render(self, name, value, attrs = None, *args, **kwargs):
+        if self.lookupField:
+            output = self.renderLookup(name, value and [value] or [], attrs, [('', self.emptyLabel)], False)
+        else:
+            output = super(ReferenceSelect, self).render(name, value, attrs, *args, **kwargs)
         return output + u'\n<a href="%s/%s/new/" target="_blank">Add new</a>' % (self.urlPrefix, self.referenceKind)
 
 
@@ -33,11 +97,15 @@ class FileInput(forms.widgets.Input):
         self.itemKey = ''
         self.fileName = ''
         self.showDownloadLink = False
-        self.__args = args
-        self.__kwargs = kwargs
 
     def __copy__(self):
-        return FileInput(*self.__args, **self.__kwargs)
+        """Copies all settings including attrs and download link of the item.
+            AdminModelForm sets the download link on its own copy of the widget.
+        """
+        widget = self.__class__.__new__(self.__class__)
+        widget.__dict__.update(self.__dict__)
+        widget.attrs = self.attrs.copy()
+        return widget
 
     def render(self, name, value, attrs = None):
         """Overrides render() method in order to attach file download
@@ -89,7 +157,14 @@ class AdminSplitDateTime(forms.SplitDateTimeWidget):
         return u'<p class="datetime">%s %s<br />%s %s</p>' % \
             ('Date:', rendered_widgets[0], 'Time:', rendered_widgets[1])
 
-class SelectMultiple(forms.SelectMultiple):
+class SelectMultiple(LookupMixin, forms.SelectMultiple):
+    urlPrefix = ''
+
+    def render(self, name, value, attrs = None, *args, **kwargs):
+        if self.lookupField:
+            return self.renderLookup(name, value or [], attrs, [], True)
+        return super(SelectMultiple, self).render(name, value, attrs, *args, **kwargs)
+
     def value_from_datadict(self, data, files, name):
         if isinstance(data, UnicodeMultiDict):
             return data.getall(name)
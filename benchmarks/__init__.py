@@ -0,0 +1,12 @@
+"""
+Performance benchmarks of the admin site.
+Benchmarks need App Engine SDK and its bundled Django on sys.path
+and are run as modules of the installed package, e.g.:
+
+    python -m appengine_admin.benchmarks.templates
+    python -m appengine_admin.benchmarks.admin_views 10000 20 results.json
+    python -m appengine_admin.benchmarks.load 16 30 10000
+    python -m appengine_admin.benchmarks.thread_safety 16 50
+
+Admin views are served on local service stubs set up by stubs module.
+"""
@@ -0,0 +1,132 @@
+"""
+Measures latency and datastore RPC counts of admin views served by the
+Admin handler on local datastore and memcache stubs. Synthetic models
+(see stubs) are seeded with the given number of items. Results are
+printed and written as JSON so that runs can be compared over time.
+
+    python -m appengine_admin.benchmarks.admin_views [items] [requests per view] [results.json]
+"""
+import datetime
+import json
+import math
+import sys
+import time
+
+from .. import admin_settings
+from .. import instrumentation
+from . import stubs
+
+
+def _scenarios(owners, tags, items):
+    """Returns (name, handler method, request maker) triples.
+        Request maker returns (path, method, content type, body) for
+        request number n.
+    """
+    prefix = '%s/%s' % (stubs.URL_PREFIX, stubs.BenchItem.kind())
+    pages = max(int(math.ceil(float(len(items)) / admin_settings.ADMIN_ITEMS_PER_PAGE)), 1)
+    middleItem = items[len(items) // 2]
+    # Seeded items with attachments are every stubs.BLOB_EVERY-th
+    blobItem = items[0]
+
+    def get(path):
+        return lambda n: (path, 'GET', None, None)
+
+    def newItem(n):
+        path, contentType, body = stubs.newItemRequest(owners, tags, n)
+        return path, 'POST', contentType, body
+
+    return [
+        ('index', 'index_get', get(stubs.URL_PREFIX + '/')),
+        ('list_first', 'list_get', get('%s/list/' % prefix)),
+        ('list_middle', 'list_get', get('%s/list/?page=%i' % (prefix, pages // 2 + 1))),
+        ('list_last', 'list_get', get('%s/list/?page=%i' % (prefix, pages))),
+        ('edit', 'edit_get', get('%s/edit/%s/' % (prefix, middleItem))),
+        ('new_post', 'new_post', newItem),
+        ('blob', 'get_blob_contents', get('%s/get_blob_contents/attachment/%s/' % (prefix, blobItem))),
+    ]
+
+
+def _latency(milliseconds):
+    values = sorted(milliseconds)
+    result = dict([('p%i' % percent, round(instrumentation.percentile(values, percent), 3))
+        for percent in instrumentation.PERCENTILES])
+    result['mean'] = round(sum(values) / len(values), 3)
+    return result
+
+
+def _measure(app, route, makeRequest, repeats):
+    """Serves a warm-up request and repeats measured ones.
+        Returns result dict of the scenario.
+    """
+    path, method, contentType, body = makeRequest(0)
+    stubs.call(app, path, method, contentType, body)
+    instrumentation.reset()
+    milliseconds = []
+    statuses = {}
+    for n in range(1, repeats + 1):
+        path, method, contentType, body = makeRequest(n)
+        response, elapsed = stubs.call(app, path, method, contentType, body)
+        milliseconds.append(elapsed)
+        statuses[response.status_int] = statuses.get(response.status_int, 0) + 1
+    stats = instrumentation.summary().get(route, {})
+    return {
+        'route': route,
+        'path': path,
+        'requests': repeats,
+        'errors': sum([count for status, count in statuses.items() if status >= 400]),
+        'statuses': dict([(str(status), count) for status, count in statuses.items()]),
+        'latency': _latency(milliseconds),
+        'render': stats.get('render'),
+        'rpcs': dict([(kind, rpc['calls']) for kind, rpc in stats.get('rpcs', {}).items()]),
+    }
+
+
+def run(nItems = 1000, repeats = 20):
+    """Seeds nItems items and measures every scenario.
+        Returns results as JSON serializable dict.
+    """
+    # RPCs are counted by admin request instrumentation
+    admin_settings.ADMIN_STATS_ENABLED = True
+    bed = stubs.setUp()
+    try:
+        start = time.time()
+        owners, tags, items = stubs.seed(nItems)
+        seedSeconds = time.time() - start
+        app = stubs.application()
+        scenarios = {}
+        for name, route, makeRequest in _scenarios(owners, tags, items):
+            scenarios[name] = _measure(app, route, makeRequest, repeats)
+    finally:
+        bed.deactivate()
+    return {
+        'benchmark': 'admin_views',
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': sys.version.split()[0],
+        'items': nItems,
+        'itemsPerPage': admin_settings.ADMIN_ITEMS_PER_PAGE,
+        'requests': repeats,
+        'seedSeconds': round(seedSeconds, 3),
+        'scenarios': scenarios,
+    }
+
+
+def main(argv):
+    nItems = len(argv) > 1 and int(argv[1]) or 1000
+    repeats = len(argv) > 2 and int(argv[2]) or 20
+    results = run(nItems, repeats)
+    print '%-12s %8s %8s %8s %8s %6s  %s' % ('view', 'p50 ms', 'p95 ms', 'p99 ms', 'mean ms', 'errors', 'rpcs per request')
+    for name, result in sorted(results['scenarios'].items()):
+        latency = result['latency']
+        rpcs = ', '.join(['%s %s' % (kind, calls) for kind, calls in sorted(result['rpcs'].items())])
+        print '%-12s %8.2f %8.2f %8.2f %8.2f %6i  %s' % (
+            name, latency['p50'], latency['p95'], latency['p99'], latency['mean'], result['errors'], rpcs)
+    if len(argv) > 3:
+        resultFile = open(argv[3], 'w')
+        try:
+            json.dump(results, resultFile, indent = 2, sort_keys = True)
+        finally:
+            resultFile.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,207 @@
+"""
+Load test of the admin WSGI application on local service stubs.
+Worker threads serve a weighted mix of list, edit, save and blob download
+requests concurrently. Throughput, latency percentiles and errors are
+reported per route and can be written as JSON.
+
+    python -m appengine_admin.benchmarks.load [threads] [seconds] [items] [mix] [results.json]
+
+where mix looks like "list=4,edit=3,save=2,blob=1" (default).
+"""
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+
+from .. import admin_settings
+from .. import instrumentation
+from . import stubs
+
+DEFAULT_MIX = 'list=4,edit=3,save=2,blob=1'
+
+# Request kind -> handler method it is routed to
+ROUTES = {
+    'list': 'list_get',
+    'edit': 'edit_get',
+    'save': 'edit_post',
+    'blob': 'get_blob_contents',
+}
+
+
+def parseMix(text):
+    """Returns list of (request kind, weight) pairs of mix text.
+        Raises ValueError on unknown kinds or bad weights.
+    """
+    mix = []
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        kind, weight = part.split('=')
+        kind = kind.strip()
+        if kind not in ROUTES:
+            raise ValueError("Unknown request kind '%s', use one of %s" % (kind, ', '.join(sorted(ROUTES))))
+        if int(weight) > 0:
+            mix.append((kind, int(weight)))
+    if not mix:
+        raise ValueError('Request mix is empty')
+    return mix
+
+
+class _Requests(object):
+    """Builds random requests of every kind for seeded items.
+    """
+    def __init__(self, owners, tags, items):
+        self.prefix = '%s/%s' % (stubs.URL_PREFIX, stubs.BenchItem.kind())
+        self.owners = owners
+        self.tags = tags
+        self.items = items
+        self.blobItems = items[::stubs.BLOB_EVERY]
+        self.pages = max(len(items) // admin_settings.ADMIN_ITEMS_PER_PAGE, 1)
+
+    def make(self, kind, rand):
+        """Returns (path, method, content type, body, expected status codes).
+        """
+        if kind == 'list':
+            # Most views are of the first pages
+            page = min(int(rand.expovariate(0.5)) + 1, self.pages)
+            return '%s/list/?page=%i' % (self.prefix, page), 'GET', None, None, (200,)
+        if kind == 'edit':
+            return '%s/edit/%s/' % (self.prefix, rand.choice(self.items)), 'GET', None, None, (200,)
+        if kind == 'save':
+            key = rand.choice(self.items)
+            number = rand.randint(0, 1000000)
+            contentType, body = stubs.multipart([
+                ('name', 'Saved item %i' % number),
+                ('owner', str(rand.choice(self.owners))),
+                ('labels', 'saved\nlabel%i' % (number % 7)),
+            ] + [('_tags', str(tag)) for tag in rand.sample(self.tags, stubs.TAGS_PER_ITEM)])
+            return '%s/edit/%s/' % (self.prefix, key), 'POST', contentType, body, (302,)
+        return ('%s/get_blob_contents/attachment/%s/' % (self.prefix, rand.choice(self.blobItems)),
+            'GET', None, None, (200,))
+
+
+class _RouteStats(object):
+    def __init__(self):
+        self.milliseconds = []
+        self.errors = 0
+        self.errorSamples = []
+
+
+def _worker(app, requests, mix, deadline, seed, results, lock):
+    rand = random.Random(seed)
+    kinds = []
+    for kind, weight in mix:
+        kinds.extend([kind] * weight)
+    local = dict([(kind, _RouteStats()) for kind, weight in mix])
+    while time.time() < deadline:
+        kind = rand.choice(kinds)
+        path, method, contentType, body, expected = requests.make(kind, rand)
+        stats = local[kind]
+        start = time.time()
+        try:
+            response, elapsed = stubs.call(app, path, method, contentType, body)
+        except Exception, exc:
+            stats.milliseconds.append((time.time() - start) * 1000.0)
+            stats.errors += 1
+            stats.errorSamples.append('%s %s: %r' % (method, path, exc))
+            continue
+        stats.milliseconds.append(elapsed)
+        if response.status_int not in expected:
+            stats.errors += 1
+            stats.errorSamples.append('%s %s: status %i' % (method, path, response.status_int))
+    lock.acquire()
+    try:
+        for kind, stats in local.items():
+            total = results.setdefault(kind, _RouteStats())
+            total.milliseconds.extend(stats.milliseconds)
+            total.errors += stats.errors
+            total.errorSamples.extend(stats.errorSamples[:5])
+    finally:
+        lock.release()
+
+
+def run(nThreads = 8, seconds = 10, nItems = 1000, mix = DEFAULT_MIX):
+    """Seeds nItems items and runs the request mix from nThreads threads
+        for given number of seconds. Returns results as JSON serializable dict.
+    """
+    mix = parseMix(mix)
+    bed = stubs.setUp()
+    try:
+        owners, tags, items = stubs.seed(nItems)
+        app = stubs.application()
+        requests = _Requests(owners, tags, items)
+        results = {}
+        lock = threading.Lock()
+        instrumentation.reset()
+        start = time.time()
+        deadline = start + seconds
+        threads = [
+            threading.Thread(target = _worker, args = (app, requests, mix, deadline, number, results, lock))
+            for number in range(nThreads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        stats = instrumentation.summary()
+    finally:
+        bed.deactivate()
+    routes = {}
+    for kind, result in results.items():
+        values = sorted(result.milliseconds)
+        if not values:
+            continue
+        routes[kind] = {
+            'route': ROUTES[kind],
+            'requests': len(values),
+            'throughput': round(len(values) / elapsed, 2),
+            'errors': result.errors,
+            'errorSamples': result.errorSamples[:10],
+            'latency': dict([('p%i' % percent, round(instrumentation.percentile(values, percent), 3))
+                for percent in instrumentation.PERCENTILES]),
+            'datastore': stats.get(ROUTES[kind], {}).get('datastore'),
+        }
+    total = sum([route['requests'] for route in routes.values()])
+    return {
+        'benchmark': 'load',
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': sys.version.split()[0],
+        'threads': nThreads,
+        'seconds': round(elapsed, 3),
+        'items': nItems,
+        'mix': dict(mix),
+        'requests': total,
+        'throughput': round(total / elapsed, 2),
+        'errors': sum([route['errors'] for route in routes.values()]),
+        'routes': routes,
+    }
+
+
+def main(argv):
+    nThreads = len(argv) > 1 and int(argv[1]) or 8
+    seconds = len(argv) > 2 and float(argv[2]) or 10
+    nItems = len(argv) > 3 and int(argv[3]) or 1000
+    mix = len(argv) > 4 and argv[4] or DEFAULT_MIX
+    results = run(nThreads, seconds, nItems, mix)
+    print '%i threads, %.1f s, %i requests, %.1f requests/s, %i errors' % (
+        results['threads'], results['seconds'], results['requests'], results['throughput'], results['errors'])
+    print '%-6s %-18s %9s %8s %8s %8s %8s %6s' % ('kind', 'route', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors')
+    for kind, route in sorted(results['routes'].items()):
+        latency = route['latency']
+        print '%-6s %-18s %9i %8.1f %8.2f %8.2f %8.2f %6i' % (kind, route['route'], route['requests'],
+            route['throughput'], latency['p50'], latency['p95'], latency['p99'], route['errors'])
+        for sample in route['errorSamples']:
+            print '       %s' % sample
+    if len(argv) > 5:
+        resultFile = open(argv[5], 'w')
+        try:
+            json.dump(results, resultFile, indent = 2, sort_keys = True)
+        finally:
+            resultFile.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,200 @@
+"""
+Local App Engine service stubs and synthetic admin models used by
+benchmarks. The admin site is served by the Admin handler in a WSGI
+application exactly as in a deployed app, only the datastore, memcache
+and users services are replaced with SDK stubs.
+"""
+import datetime
+import logging
+import pickle
+import time
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+from google.appengine.ext import webapp
+
+import webob
+
+from .. import db_extensions
+from .. import instrumentation
+from .. import model_register
+from .. import utils
+from .. import views
+
+# Url prefix of the admin site in benchmark application
+URL_PREFIX = '/admin'
+
+# Referenced entities shared by seeded items
+N_OWNERS = 100
+N_TAGS = 50
+TAGS_PER_ITEM = 3
+
+# Every BLOB_EVERY-th seeded item has an attachment of BLOB_SIZE bytes
+BLOB_EVERY = 10
+BLOB_SIZE = 1024
+
+SEED_BATCH_SIZE = 500
+
+_MULTIPART_BOUNDARY = 'appengine-admin-benchmark-boundary'
+
+
+class BenchOwner(db.Model):
+    name = db.StringProperty()
+
+    def __unicode__(self):
+        return self.name
+
+
+class BenchTag(db.Model):
+    name = db.StringProperty()
+
+    def __unicode__(self):
+        return self.name
+
+
+class BenchItem(db.Model):
+    name = db.StringProperty()
+    owner = db.ReferenceProperty(BenchOwner)
+    _tags = db_extensions.ManyToManyProperty(BenchTag)
+    labels = db.StringListProperty()
+    created = db.DateTimeProperty(auto_now_add = True)
+    attachment = db.BlobProperty()
+    attachment_meta = db.BlobProperty()
+
+
+class BenchOwnerAdmin(model_register.ModelAdmin):
+    model = BenchOwner
+    listFields = ('name',)
+    editFields = ('name',)
+
+
+class BenchTagAdmin(model_register.ModelAdmin):
+    model = BenchTag
+    listFields = ('name',)
+    editFields = ('name',)
+
+
+class BenchItemAdmin(model_register.ModelAdmin):
+    model = BenchItem
+    listFields = ('name', 'owner', '_tags', 'labels', 'created', 'attachment')
+    editFields = ('name', 'owner', '_tags', 'labels', 'attachment')
+    readonlyFields = ('created',)
+
+
+def setUp(userEmail = 'admin@example.com'):
+    """Activates service stubs, signs in an admin user and
+        registers synthetic models. Returns the testbed for deactivate().
+    """
+    bed = testbed.Testbed()
+    bed.activate()
+    # Seeded items are visible to queries right away
+    bed.init_datastore_v3_stub(
+        consistency_policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability = 1),
+        require_indexes = False
+    )
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.setup_env(overwrite = True, USER_EMAIL = userEmail, USER_ID = '1', USER_IS_ADMIN = '1')
+    # Hooks installed when views were imported belong to the replaced API proxy
+    instrumentation.install()
+    model_register.register(BenchOwnerAdmin, BenchTagAdmin, BenchItemAdmin)
+    return bed
+
+
+def application(prefixPattern = URL_PREFIX):
+    """Returns WSGI application that serves the admin site at url prefixes
+        matched by given regular expression (URL_PREFIX by default).
+    """
+    return webapp.WSGIApplication([(r'^(%s)(.*)$' % prefixPattern, views.Admin)])
+
+
+def seed(nItems, blobSize = BLOB_SIZE):
+    """Stores nItems items with their owners and tags in batches.
+        Returns (owner keys, tag keys, item keys).
+    """
+    owners = db.put([BenchOwner(name = u'Owner %03i' % number) for number in range(N_OWNERS)])
+    tags = db.put([BenchTag(name = u'tag%02i' % number) for number in range(N_TAGS)])
+    created = datetime.datetime(2010, 1, 1)
+    blob = db.Blob('x' * blobSize)
+    meta = db.Blob(blobMeta('attachment.bin', blobSize))
+    items = []
+    for start in range(0, nItems, SEED_BATCH_SIZE):
+        batch = []
+        for number in range(start, min(start + SEED_BATCH_SIZE, nItems)):
+            item = BenchItem(
+                name = u'Item %06i' % number,
+                owner = owners[number % N_OWNERS],
+                _tags = [tags[(number + offset) % N_TAGS] for offset in range(TAGS_PER_ITEM)],
+                labels = [u'label%i' % (number % 7), u'group%i' % (number % 13)],
+                created = created + datetime.timedelta(minutes = number)
+            )
+            if number % BLOB_EVERY == 0:
+                item.attachment = blob
+                item.attachment_meta = meta
+            batch.append(item)
+        items.extend(db.put(batch))
+        logging.info('Seeded %i of %i items' % (len(items), nItems))
+    return owners, tags, items
+
+
+def blobMeta(fileName, size):
+    """Returns pickled blob meta info as saved by AdminModelForm.
+    """
+    return pickle.dumps({
+        'Content_Type': 'application/octet-stream',
+        'File_Name': fileName,
+        'File_Size': size,
+        'Content_Hash': utils.blobHash('x' * size),
+        'Upload_Date': datetime.datetime(2010, 1, 1),
+    })
+
+
+def multipart(fields, files = ()):
+    """Returns (content type, body) of multipart/form-data request.
+        fields - (name, value) pairs, files - (name, file name, data) triples
+    """
+    lines = []
+    for name, value in fields:
+        lines.extend(['--' + _MULTIPART_BOUNDARY, 'Content-Disposition: form-data; name="%s"' % name, '', value])
+    for name, fileName, data in files:
+        lines.extend([
+            '--' + _MULTIPART_BOUNDARY,
+            'Content-Disposition: form-data; name="%s"; filename="%s"' % (name, fileName),
+            'Content-Type: application/octet-stream',
+            '',
+            data,
+        ])
+    lines.extend(['--' + _MULTIPART_BOUNDARY + '--', ''])
+    return 'multipart/form-data; boundary=%s' % _MULTIPART_BOUNDARY, '\r\n'.join(lines)
+
+
+def newItemRequest(owners, tags, number):
+    """Returns (path, content type, body) of new_post request that
+        creates an item with all property types and an uploaded blob.
+    """
+    contentType, body = multipart(
+        [
+            ('name', 'New item %i' % number),
+            ('owner', str(owners[number % len(owners)])),
+            ('labels', 'new\nlabel%i' % (number % 7)),
+        ] + [('_tags', str(key)) for key in tags[:TAGS_PER_ITEM]],
+        [('attachment', 'upload%i.bin' % number, 'y' * BLOB_SIZE)]
+    )
+    return '%s/%s/new/' % (URL_PREFIX, BenchItem.kind()), contentType, body
+
+
+def call(app, path, method = 'GET', contentType = None, body = None, headers = None):
+    """Serves one request by the application.
+        Returns (response, milliseconds).
+    """
+    request = webob.Request.blank(path)
+    request.method = method
+    if body is not None:
+        request.content_type = contentType
+        request.body = body
+    for name, value in (headers or {}).items():
+        request.headers[name] = value
+    start = time.time()
+    response = request.get_response(app)
+    return response, (time.time() - start) * 1000.0
@@ -0,0 +1,104 @@
+"""
+Compares render time of admin templates looked up by path on every
+render (webapp template.render() as admin views did before) with
+template_registry that renders precompiled templates into the response.
+
+    python -m appengine_admin.benchmarks.templates [renders per template]
+"""
+import os.path
+import StringIO
+import sys
+import time
+
+from google.appengine.ext.webapp import template
+
+from .. import admin_settings
+from .. import list_options
+from .. import template_registry
+
+
+class _Property(object):
+    def __init__(self, name, value):
+        self.name = name
+        self.verbose_name = name
+        self.value = value
+        self.isBlob = False
+
+
+class _Item(object):
+    def __init__(self, number, properties):
+        self.key = 'agdleGFtcGxlcgoLEgRJdGVtGAEM%06i' % number
+        self.listProperties = [_Property(name, u'%s value %i' % (name, number)) for name in properties]
+
+
+def _contexts(nItems = admin_settings.ADMIN_ITEMS_PER_PAGE):
+    """Returns (template name, values) pairs that resemble real admin pages.
+    """
+    properties = ['name', 'created', 'owner', 'tags']
+    base = {
+        'models': ['Model%02i' % number for number in range(20)],
+        'urlPrefix': '/admin',
+        'moduleTitle': 'Item',
+    }
+    items = [_Item(number, properties) for number in range(nItems)]
+    row = dict(base, item = items[0])
+    page = {'first': 1, 'prev': 1, 'current': 2, 'next': 3, 'last': 10, 'maxpages': 10}
+    listPage = dict(base,
+        listColumns = [list_options.ListColumn(_Property(name, ''), name, None) for name in properties],
+        bulkEditProperties = [_Property(name, '') for name in properties],
+        listRows = u''.join([template_registry.render('model_item_list_row.html', dict(row, item = item)) for item in items]),
+        listPaging = template_registry.render('model_item_list_paging.html', {'page': page}),
+    )
+    editForm = u''.join([
+        u'<tr><th><label for="id_%s">%s:</label></th><td><input type="text" name="%s" id="id_%s"/></td></tr>' % (name, name, name, name)
+        for name in properties
+    ])
+    return [
+        ('index.html', base),
+        ('model_item_list.html', listPage),
+        ('model_item_list_row.html', row),
+        ('model_item_edit.html', dict(base, item = None, editForm = editForm, readonlyProperties = [])),
+        ('404.html', {'errorpage': True}),
+        ('500.html', {'errorpage': True}),
+    ]
+
+
+def _byPath(name, values):
+    path = os.path.join(admin_settings.ADMIN_TEMPLATE_DIR, name)
+    out = StringIO.StringIO()
+    out.write(template.render(path, values).decode('UTF-8'))
+
+
+def _registry(name, values):
+    template_registry.write(StringIO.StringIO(), name, values)
+
+
+def _measure(render, name, values, renders):
+    start = time.time()
+    for i in range(renders):
+        render(name, values)
+    return (time.time() - start) * 1000.0 / renders
+
+
+def run(renders = 200):
+    """Returns list of (template name, ms per render by path, ms per render by registry).
+    """
+    template_registry.preload()
+    results = []
+    for name, values in _contexts():
+        # warm up both paths so that only rendering is compared
+        _byPath(name, values)
+        _registry(name, values)
+        results.append((name, _measure(_byPath, name, values, renders), _measure(_registry, name, values, renders)))
+    return results
+
+
+def main(argv):
+    renders = len(argv) > 1 and int(argv[1]) or 200
+    print '%-30s %12s %12s %8s' % ('template', 'path ms', 'registry ms', 'speedup')
+    for name, before, after in run(renders):
+        print '%-30s %12.3f %12.3f %7.2fx' % (name, before, after, after and before / after or 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,101 @@
+"""
+Stress test of per-request state isolation of the admin handler.
+Every thread serves the admin site at its own url prefix (/admin0/,
+/admin1/, ...) and requests edit pages of items with uploaded blobs and
+list pages concurrently. Every response must contain links with the
+thread's own prefix only, and blob download links of the requested
+item only. Leaks are reported and the exit status is 1 if any was found.
+
+    python -m appengine_admin.benchmarks.thread_safety [threads] [requests per thread] [items]
+"""
+import random
+import re
+import sys
+import threading
+
+from . import stubs
+
+_PREFIX_LINK = re.compile(re.escape(stubs.URL_PREFIX) + r'(\d+)/')
+_DOWNLOAD_LINK = re.compile(r'/get_blob_contents/attachment/([^/"]+)/')
+
+
+def _check(body, prefix, itemKey):
+    """Returns list of problems found in response body.
+    """
+    problems = []
+    prefixes = set([stubs.URL_PREFIX + number for number in _PREFIX_LINK.findall(body)])
+    prefixes.discard(prefix)
+    if prefixes:
+        problems.append('links with url prefixes of other requests: %s' % ', '.join(sorted(prefixes)))
+    if itemKey is not None:
+        keys = set(_DOWNLOAD_LINK.findall(body))
+        if keys != set([itemKey]):
+            problems.append('download links of items %s instead of %s' % (', '.join(sorted(keys)) or 'none', itemKey))
+    return problems
+
+
+def _worker(app, number, blobItems, nRequests, failures, lock):
+    rand = random.Random(number)
+    prefix = '%s%i' % (stubs.URL_PREFIX, number)
+    modelPath = '%s/%s' % (prefix, stubs.BenchItem.kind())
+    found = []
+    for n in range(nRequests):
+        if rand.random() < 0.75:
+            itemKey = str(rand.choice(blobItems))
+            path = '%s/edit/%s/' % (modelPath, itemKey)
+        else:
+            itemKey = None
+            path = '%s/list/?page=%i' % (modelPath, rand.randint(1, 3))
+        try:
+            response, elapsed = stubs.call(app, path)
+        except Exception, exc:
+            found.append('%s: %r' % (path, exc))
+            continue
+        if response.status_int != 200:
+            found.append('%s: status %i' % (path, response.status_int))
+            continue
+        for problem in _check(response.body, prefix, itemKey):
+            found.append('%s: %s' % (path, problem))
+    lock.acquire()
+    try:
+        failures.extend(found)
+    finally:
+        lock.release()
+
+
+def run(nThreads = 16, nRequests = 50, nItems = 200):
+    """Returns (number of requests, list of problems found).
+    """
+    bed = stubs.setUp()
+    try:
+        owners, tags, items = stubs.seed(nItems)
+        app = stubs.application(stubs.URL_PREFIX + r'\d+')
+        blobItems = items[::stubs.BLOB_EVERY]
+        failures = []
+        lock = threading.Lock()
+        threads = [
+            threading.Thread(target = _worker, args = (app, number, blobItems, nRequests, failures, lock))
+            for number in range(nThreads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        bed.deactivate()
+    return nThreads * nRequests, failures
+
+
+def main(argv):
+    nThreads = len(argv) > 1 and int(argv[1]) or 16
+    nRequests = len(argv) > 2 and int(argv[2]) or 50
+    nItems = len(argv) > 3 and int(argv[3]) or 200
+    total, failures = run(nThreads, nRequests, nItems)
+    for failure in failures[:50]:
+        print failure
+    print '%i requests from %i threads, %i problems' % (total, nThreads, len(failures))
+    return failures and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
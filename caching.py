@@ -0,0 +1,104 @@
+"""
+Memcache caches of data derived from items of particular model.
+Cached values are keyed by the model's generation number that is
+increased on every write done through admin site, so changed data
+is never read from cache and stale values just expire.
+"""
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from . import admin_settings
+
+# Values cached for the request served by current thread
+_local = threading.local()
+
+
+def _requestCache():
+    """Returns cache key -> value mapping of current admin request.
+        Outside admin requests values are not kept.
+    """
+    values = getattr(_local, 'values', None)
+    if values is None:
+        return {}
+    return values
+
+
+def startRequest():
+    """Starts caching values for the admin request served by current thread.
+    """
+    _local.values = {}
+
+
+def finishRequest():
+    """Forgets values cached by current admin request.
+    """
+    _local.values = None
+
+
+def _generationKey(kind):
+    return 'appengine_admin:generation:%s' % kind
+
+
+def getGeneration(kind):
+    """Returns current generation number of the model.
+        Missing number is initialized from current time so that it does not
+        repeat numbers used before it was evicted from memcache.
+    """
+    cacheKey = _generationKey(kind)
+    requestCache = _requestCache()
+    if cacheKey in requestCache:
+        return requestCache[cacheKey]
+    generation = memcache.get(cacheKey)
+    if generation is None:
+        memcache.add(cacheKey, int(time.time()))
+        generation = memcache.get(cacheKey) or 0
+    requestCache[cacheKey] = generation
+    return generation
+
+
+def bumpGeneration(kind):
+    """Invalidates all cached values of the model.
+        Called after items of the model are created, changed or deleted.
+    """
+    cacheKey = _generationKey(kind)
+    _requestCache().pop(cacheKey, None)
+    if memcache.incr(cacheKey) is None:
+        memcache.set(cacheKey, int(time.time()))
+
+
+def getValue(kind, name):
+    """Returns value cached for current generation of the model or None.
+    """
+    cacheKey = 'appengine_admin:%s:%s:%s' % (name, kind, getGeneration(kind))
+    requestCache = _requestCache()
+    if cacheKey not in requestCache:
+        requestCache[cacheKey] = memcache.get(cacheKey)
+    return requestCache[cacheKey]
+
+
+def setValue(kind, name, value, cacheTime = 0):
+    """Caches value for current generation of the model.
+        Values too big for memcache are cached for current request only.
+    """
+    cacheKey = 'appengine_admin:%s:%s:%s' % (name, kind, getGeneration(kind))
+    _requestCache()[cacheKey] = value
+    try:
+        memcache.set(cacheKey, value, time = cacheTime)
+    except ValueError, exc:
+        logging.warning("Value '%s' of model '%s' not cached: %s" % (name, kind, exc))
+
+
+def getChoices(model):
+    """Returns list of (key, label) pairs of all items of the model
+        for reference field choices.
+    """
+    kind = model.kind()
+    choices = getValue(kind, 'choices')
+    if choices is None:
+        logging.info("Loading choices of model '%s'" % kind)
+        choices = [(item.key(), unicode(item)) for item in model.all()]
+        setValue(kind, 'choices', choices, cacheTime = admin_settings.ADMIN_CHOICES_CACHE_TIME)
+    return choices
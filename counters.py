@@ -0,0 +1,185 @@
+"""
+Item count providers for list view paging.
+Count provider is selected by ModelAdmin.listCount.
+"""
+import logging
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext.db import stats
+
+from . import admin_settings
+
+
+class CountProvider(object):
+    """Base class for count providers.
+        count() returns total number of items of the model or None if
+        the total is not known.
+        exact tells if the count can be used for validating page numbers.
+        If it is False list view finds next page by fetching an extra item.
+        tracksChanges tells if change() updates the count; admin site makes
+        sure then that only existing items are counted as deleted.
+    """
+    exact = False
+    tracksChanges = False
+
+    def count(self, modelAdmin):
+        raise NotImplementedError()
+
+    def change(self, modelAdmin, delta):
+        """Called after admin site created (delta > 0) or deleted (delta < 0) items.
+        """
+        pass
+
+
+class QueryCount(CountProvider):
+    """Counts items with a datastore query on every request.
+        Cost grows linearly with the number of items.
+    """
+    exact = True
+
+    def count(self, modelAdmin):
+        return modelAdmin.model.all().count()
+
+
+class StatsCount(CountProvider):
+    """Reads count from datastore statistics (__Stat_Kind__ entities).
+        Statistics are updated by App Engine about once a day. There are
+        no statistics on development server so the total is unknown there.
+    """
+    def count(self, modelAdmin):
+        stat = stats.KindStat.all().filter('kind_name =', modelAdmin.modelName).get()
+        if stat is None:
+            return None
+        return stat.count
+
+
+class MemcacheCount(CountProvider):
+    """Keeps query count in memcache for given time (in seconds).
+        Items created or deleted through admin site are accounted
+        for immediately.
+    """
+    tracksChanges = True
+
+    def __init__(self, time = admin_settings.ADMIN_COUNT_CACHE_TIME):
+        self.time = time
+
+    @staticmethod
+    def _cacheKey(modelName):
+        return 'appengine_admin:count:%s' % modelName
+
+    def count(self, modelAdmin):
+        cacheKey = self._cacheKey(modelAdmin.modelName)
+        nItems = memcache.get(cacheKey)
+        if nItems is None:
+            nItems = modelAdmin.model.all().count()
+            memcache.set(cacheKey, nItems, time = self.time)
+        return nItems
+
+    def change(self, modelAdmin, delta):
+        # Missing values are not created by incr/decr, count() does it.
+        cacheKey = self._cacheKey(modelAdmin.modelName)
+        if delta > 0:
+            memcache.incr(cacheKey, delta)
+        elif delta < 0:
+            memcache.decr(cacheKey, -delta)
+
+
+class CounterShard(db.Model):
+    """One shard of ShardedCount counter.
+        Key name: "<model name>:<shard number>".
+    """
+    count = db.IntegerProperty(default = 0)
+
+    @classmethod
+    def kind(cls):
+        return '_AdminCounterShard'
+
+
+class ShardedCount(CountProvider):
+    """Counter that is maintained by admin site writes. Counter is split
+        into shards to avoid contention on a single entity.
+        Shard 0 holds the number of items found by a query when the counter
+        was started, other shards hold the changes made since then.
+        Items written without admin site are not counted.
+    """
+    tracksChanges = True
+
+    def __init__(self, shards = admin_settings.ADMIN_COUNTER_SHARDS):
+        self.shards = shards
+
+    @staticmethod
+    def _shardName(modelName, shard):
+        return '%s:%i' % (modelName, shard)
+
+    def count(self, modelAdmin):
+        keys = [
+            db.Key.from_path(CounterShard.kind(), self._shardName(modelAdmin.modelName, shard))
+            for shard in range(self.shards + 1)
+        ]
+        shards = db.get(keys)
+        changes = sum([shard.count for shard in shards[1:] if shard is not None])
+        if shards[0] is None:
+            return self._start(modelAdmin, changes)
+        return shards[0].count + changes
+
+    def _start(self, modelAdmin, changes):
+        """Starts the counter from query count.
+            Changes already recorded in other shards are included in the query count.
+        """
+        nItems = modelAdmin.model.all().count()
+        name = self._shardName(modelAdmin.modelName, 0)
+        logging.info("Starting item counter for model '%s' at %i" % (modelAdmin.modelName, nItems))
+        def txn():
+            if CounterShard.get_by_key_name(name) is None:
+                CounterShard(key_name = name, count = nItems - changes).put()
+        db.run_in_transaction(txn)
+        return nItems
+
+    def change(self, modelAdmin, delta):
+        name = self._shardName(modelAdmin.modelName, random.randint(1, self.shards))
+        def txn():
+            shard = CounterShard.get_by_key_name(name)
+            if shard is None:
+                shard = CounterShard(key_name = name)
+            shard.count += delta
+            shard.put()
+        db.run_in_transaction(txn)
+
+
+class ListCount(CountProvider):
+    """Counts items of a known key list such as search results.
+    """
+    exact = True
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def count(self, modelAdmin):
+        return len(self.keys)
+
+
+class NoCount(CountProvider):
+    """Does not count at all. List view shows only current page number.
+    """
+    def count(self, modelAdmin):
+        return None
+
+
+# Count providers by ModelAdmin.listCount value
+countProviders = {
+    'query': QueryCount(),
+    'stats': StatsCount(),
+    'memcache': MemcacheCount(),
+    'sharded': ShardedCount(),
+    'none': NoCount(),
+}
+
+def getCountProvider(listCount):
+    """Returns count provider for ModelAdmin.listCount value
+        that is either a name or CountProvider instance.
+    """
+    if isinstance(listCount, basestring):
+        return countProviders[listCount]
+    return listCount
@@ -0,0 +1,301 @@
+"""
+Export and import of model data in CSV and JSON lines formats.
+"""
+import csv
+import datetime
+import StringIO
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from google.appengine.api import users
+from google.appengine.api import datastore_errors
+from google.appengine.ext import db
+try:
+    from django import newforms as forms
+except ImportError:
+    from django import forms
+
+from . import admin_settings
+from . import caching
+from . import search
+from . import utils
+
+# Formats: name -> (content type, file extension)
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson; charset=utf-8', 'jsonl'),
+}
+
+# Blob meta info exported in place of blob contents
+EXPORTED_BLOB_META = ('File_Name', 'Content_Type', 'File_Size')
+
+
+def iterQuery(query, batchSize):
+    """Yields all results of the query fetching batchSize results
+        per datastore call. Only one batch is held in memory at once.
+    """
+    cursor = None
+    while True:
+        if cursor:
+            query.with_cursor(cursor)
+        batch = query.fetch(batchSize)
+        for item in batch:
+            yield item
+        if len(batch) < batchSize:
+            return
+        cursor = query.cursor()
+
+
+def exportProperties(modelAdmin, allFields = False):
+    """Returns PropertyWrapper instances for exported fields.
+        These are list fields or all model properties except blob meta info fields.
+    """
+    if not allFields:
+        return modelAdmin._listProperties
+    return modelAdmin._allProperties
+
+
+def exportValue(item, prop):
+    """Returns JSON compatible value of the property of given item.
+        References are exported as keys without fetching referenced items,
+        blobs as their meta info summary.
+    """
+    if prop.isBlob:
+        meta = utils.getBlobProperties(item, prop.name)
+        if not meta:
+            return None
+        return dict([(name, meta[name]) for name in EXPORTED_BLOB_META if name in meta])
+    if prop.typeName == 'ReferenceProperty':
+        value = prop.prop.get_value_for_datastore(item)
+    else:
+        value = getattr(item, prop.name)
+    if hasattr(value, '__call__'):
+        # support for methods
+        value = value()
+    return _jsonValue(value)
+
+
+def _jsonValue(value):
+    if isinstance(value, (list, tuple)):
+        return [_jsonValue(element) for element in value]
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, db.Key):
+        return str(value)
+    if isinstance(value, users.User):
+        return value.email()
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    return unicode(value)
+
+
+def _csvValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def exportRows(modelAdmin, allFields = False, fileFormat = 'csv'):
+    """Generator yielding exported data of all items matched by listGql
+        as strings (header first for CSV). Items are fetched in batches
+        of admin_settings.ADMIN_EXPORT_BATCH_SIZE.
+    """
+    properties = exportProperties(modelAdmin, allFields)
+    query = modelAdmin.model.gql(modelAdmin.listGql)
+    if fileFormat == 'csv':
+        buffer = StringIO.StringIO()
+        writer = csv.writer(buffer)
+        def csvLine(row):
+            writer.writerow(row)
+            line = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return line
+        yield csvLine(['key'] + [prop.name for prop in properties])
+        for item in iterQuery(query, admin_settings.ADMIN_EXPORT_BATCH_SIZE):
+            yield csvLine([str(item.key())] + [_csvValue(exportValue(item, prop)) for prop in properties])
+    else:
+        for item in iterQuery(query, admin_settings.ADMIN_EXPORT_BATCH_SIZE):
+            row = {'key': str(item.key())}
+            for prop in properties:
+                row[prop.name] = exportValue(item, prop)
+            yield json.dumps(row) + '\n'
+
+
+def iterLines(chunks):
+    """Yields lines (with line ends) of text given in chunks of arbitrary size.
+    """
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def readRows(lines, fileFormat = 'csv'):
+    """Yields (row, error) pairs for imported data lines.
+        row is a dict of field values or None if the row can not be parsed.
+        CSV data must start with a header line of field names.
+    """
+    lines = iter(lines)
+    if fileFormat == 'csv':
+        reader = csv.reader(lines)
+        try:
+            header = [name.strip() for name in reader.next()]
+        except StopIteration:
+            return
+        if header and header[0].startswith('\xef\xbb\xbf'):
+            # UTF-8 byte order mark
+            header[0] = header[0][3:]
+        while True:
+            try:
+                values = reader.next()
+            except StopIteration:
+                return
+            except csv.Error, exc:
+                yield None, unicode(exc)
+                continue
+            try:
+                yield dict(zip(header, [value.decode('utf-8') for value in values])), None
+            except UnicodeDecodeError, exc:
+                yield None, unicode(exc)
+    else:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError, exc:
+                yield None, unicode(exc)
+                continue
+            if isinstance(row, dict):
+                yield row, None
+            else:
+                yield None, u'Line is not a JSON object'
+
+
+def _formData(modelAdmin, row):
+    """Converts imported row values to AdminForm data.
+        Values are expected in the format produced by exportRows().
+    """
+    data = {}
+    for name, field in modelAdmin.AdminForm.base_fields.items():
+        if name not in row:
+            continue
+        value = row[name]
+        if isinstance(field, forms.FileField):
+            # Blobs are exported as meta info only and can not be imported
+            continue
+        prop = getattr(modelAdmin.model, name, None)
+        if isinstance(value, basestring) and value.startswith('[') and isinstance(prop, db.ListProperty):
+            # List values are stored as JSON in CSV
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        if value is None:
+            value = ''
+        if isinstance(field.widget, forms.MultiWidget):
+            # Date and time of ISO datetime go to separate widgets
+            parts = unicode(value).replace('T', ' ').split(' ', 1)
+            for i in range(len(field.widget.widgets)):
+                data['%s_%i' % (name, i)] = i < len(parts) and parts[i] or ''
+        elif isinstance(field, forms.MultipleChoiceField):
+            if not isinstance(value, list):
+                value = value and [value] or []
+            data[name] = [unicode(element) for element in value]
+        elif isinstance(value, list):
+            # Textarea with one value per line
+            data[name] = u'\n'.join([unicode(element) for element in value])
+        else:
+            data[name] = unicode(value)
+    return data
+
+
+class Importer(object):
+    """Validates imported rows with ModelAdmin.AdminForm and writes
+        valid items with one db.put per batch of rows.
+        Rows with non-empty "key" value update existing items unless
+        ignoreKeys is set. In dry run mode nothing is written.
+        errors holds up to admin_settings.ADMIN_IMPORT_MAX_ERRORS
+        (row number, field, message) tuples.
+    """
+    def __init__(self, modelAdmin, dryRun = False, ignoreKeys = False):
+        self.modelAdmin = modelAdmin
+        self.dryRun = dryRun
+        self.ignoreKeys = ignoreKeys
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+
+    def addError(self, rowNumber, fieldName, message):
+        if len(self.errors) < admin_settings.ADMIN_IMPORT_MAX_ERRORS:
+            self.errors.append((rowNumber, fieldName, message))
+
+    def importBatch(self, rows):
+        """Imports list of (row number, row, parse error) tuples.
+        """
+        keys = {}
+        badKeys = set()
+        if not self.ignoreKeys:
+            for rowNumber, row, error in rows:
+                if row and row.get('key'):
+                    try:
+                        keys[rowNumber] = db.Key(row['key'])
+                    except (datastore_errors.BadKeyError, datastore_errors.BadArgumentError, UnicodeError):
+                        # e.g. number instead of key string in JSON
+                        badKeys.add(rowNumber)
+        instances = {}
+        if keys:
+            instances = dict(zip(keys.values(), db.get(keys.values())))
+        items = []
+        created = 0
+        for rowNumber, row, error in rows:
+            if error:
+                self.failed += 1
+                self.addError(rowNumber, '', error)
+                continue
+            instance = None
+            if rowNumber in badKeys:
+                self.failed += 1
+                self.addError(rowNumber, 'key', u'Not a valid key')
+                continue
+            if not self.ignoreKeys and row.get('key'):
+                instance = instances.get(keys.get(rowNumber))
+                if instance is None or instance.kind() != self.modelAdmin.modelName:
+                    self.failed += 1
+                    self.addError(rowNumber, 'key', u'Item not found')
+                    continue
+            form = self.modelAdmin.AdminForm(data = _formData(self.modelAdmin, row), instance = instance)
+            try:
+                if not form.is_valid():
+                    self.failed += 1
+                    for fieldName, messages in form.errors.items():
+                        self.addError(rowNumber, fieldName, u' '.join([unicode(message) for message in messages]))
+                    continue
+                items.append(form.save(commit = False))
+            except (ValueError, datastore_errors.Error), exc:
+                # Reference fields raise datastore errors for malformed keys,
+                # keys of other apps and keys of deleted items
+                self.failed += 1
+                self.addError(rowNumber, '', unicode(exc) or exc.__class__.__name__)
+                continue
+            if instance is None:
+                created += 1
+        if items and not self.dryRun:
+            db.put(items)
+            search.indexItems(self.modelAdmin.searchFields, items)
+            self.modelAdmin.countProvider.change(self.modelAdmin, created)
+            caching.bumpGeneration(self.modelAdmin.modelName)
+        self.created += created
+        self.updated += len(items) - created
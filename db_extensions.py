@@ -3,9 +3,14 @@ Database functionality extensions.
 ManyToManyProperty taken from http://django-gae-helpers.googlecode.com/svn/trunk/gaeadapter.py
 """
 
+import logging
+import uuid
+
 from google.appengine.ext import db
 from google.appengine.api.datastore_errors import BadValueError
 
+import admin_settings
+
 
 class NotImplementedException(Exception):
     pass
@@ -197,3 +202,94 @@ class StringListChoicesProperty(db.StringListProperty):
 
         value = self.validate_list_contents(value)
         return value
+
+
+class ChunkedBlobProperty(db.StringProperty):
+    """Blob property for files that do not fit into a single entity.
+        File content is stored in BlobChunk entities and the property
+        holds only the id of stored blob. Every upload gets a new blob id
+        so chunks of a blob never change.
+    """
+    def __init__(self, verbose_name = None, **kwargs):
+        kwargs.setdefault('indexed', False)
+        super(ChunkedBlobProperty, self).__init__(verbose_name, **kwargs)
+
+    @staticmethod
+    def newBlobId():
+        return uuid.uuid4().hex
+
+
+class BlobChunk(db.Model):
+    """Part of ChunkedBlobProperty content.
+        Key name: "<blob id>:<chunk number>".
+    """
+    data = db.BlobProperty()
+
+    @classmethod
+    def kind(cls):
+        return '_AdminBlobChunk'
+
+def _chunkKey(blobId, number):
+    return db.Key.from_path(BlobChunk.kind(), '%s:%08i' % (blobId, number))
+
+def _chunkKeysQuery(blobId):
+    # Key names of the blob chunks are between "<blob id>:" and "<blob id>;"
+    return BlobChunk.all(keys_only = True).filter(
+        '__key__ >=', db.Key.from_path(BlobChunk.kind(), blobId + ':')).filter(
+        '__key__ <', db.Key.from_path(BlobChunk.kind(), blobId + ';'))
+
+def putBlobChunks(blobId, chunks):
+    """Stores data pieces yielded by chunks as BlobChunk entities
+        of given blob with batched puts. Returns number of chunks.
+    """
+    batch = []
+    count = 0
+    for data in chunks:
+        batch.append(BlobChunk(key = _chunkKey(blobId, count), data = db.Blob(data)))
+        count += 1
+        if len(batch) == admin_settings.ADMIN_BLOB_CHUNK_BATCH:
+            db.put(batch)
+            batch = []
+    if batch:
+        db.put(batch)
+    return count
+
+def readBlobChunks(blobId, firstChunk, lastChunk):
+    """Yields data of blob chunks from firstChunk to lastChunk (inclusive).
+        Only admin_settings.ADMIN_BLOB_CHUNK_BATCH chunks are held in memory at once.
+    """
+    batchSize = admin_settings.ADMIN_BLOB_CHUNK_BATCH
+    for start in range(firstChunk, lastChunk + 1, batchSize):
+        keys = [_chunkKey(blobId, number) for number in range(start, min(start + batchSize, lastChunk + 1))]
+        for chunk in db.get(keys):
+            if chunk is None:
+                logging.warning("Chunk of blob '%s' is missing" % blobId)
+                return
+            yield chunk.data
+
+def getBlobChunkInfo(blobId):
+    """Returns (chunk count, chunk size, total size) of stored blob.
+        Used for blobs without meta info.
+    """
+    keys = list(_chunkKeysQuery(blobId))
+    if not keys:
+        return 0, admin_settings.ADMIN_BLOB_CHUNK_SIZE, 0
+    first, last = db.get([keys[0], keys[-1]])
+    chunkSize = len(first.data)
+    return len(keys), chunkSize, chunkSize * (len(keys) - 1) + len(last.data)
+
+def deleteBlobChunks(blobId):
+    """Deletes all chunks of given blob.
+    """
+    keys = list(_chunkKeysQuery(blobId))
+    for start in range(0, len(keys), 500):
+        db.delete(keys[start:start + 500])
+
+def deleteItemBlobChunks(item):
+    """Deletes chunks of all ChunkedBlobProperty values of given item.
+    """
+    for name, prop in item.properties().iteritems():
+        if isinstance(prop, ChunkedBlobProperty):
+            blobId = getattr(item, name)
+            if blobId:
+                deleteBlobChunks(blobId)
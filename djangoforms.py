@@ -96,7 +96,7 @@ import logging
 
 import django.core.exceptions
 import django.utils.datastructures
-import db_extensions, admin_forms, admin_widgets
+import db_extensions, admin_forms, admin_widgets, caching
 
 
 try:
@@ -507,6 +507,34 @@ class ManyToManyProperty(db_extensions.ManyToManyProperty):
         return super(ManyToManyProperty, self).get_form_field(**defaults)
 
 
+class ChunkedBlobProperty(db_extensions.ChunkedBlobProperty):
+    __metaclass__ = monkey_patch
+
+    def get_form_field(self, **kwargs):
+        """Return a Django form field appropriate for a chunked blob property.
+
+        The field keeps uploaded file unread until the form is saved.
+        """
+        defaults = {'form_class': admin_forms.ChunkedFileField}
+        defaults.update(kwargs)
+        return db.Property.get_form_field(self, **defaults)
+
+    def get_value_for_form(self, instance):
+        """There is no way to convert a blob into an initial value for a file
+        upload, so we always return None.
+        """
+        return None
+
+    def make_value_from_form(self, value):
+        """Convert a form value to a property value.
+
+        This returns the id under which admin_forms.ChunkedUpload will be stored.
+        """
+        if isinstance(value, admin_forms.ChunkedUpload):
+            return value.blobId
+        return super(ChunkedBlobProperty, self).make_value_from_form(value)
+
+
 class StringListChoicesProperty(db_extensions.StringListChoicesProperty):
     __metaclass__ = monkey_patch
 
@@ -567,6 +595,8 @@ class ModelChoiceField(forms.Field):
         like for forms.Field.__init__(); widget defaults to forms.Select
     """
     assert issubclass(reference_class, db.Model)
+    # Choices of all items are shared through caching module
+    self._cache_choices = query is None
     if query is None:
       query = db.Query(reference_class)
     assert isinstance(query, db.Query)
@@ -595,6 +625,7 @@ class ModelChoiceField(forms.Field):
     As a side effect, the widget's choices are updated.
     """
     self._query = query
+    self._cache_choices = False
     self._update_widget_choices()
 
   query = property(_get_query, _set_query)
@@ -605,6 +636,10 @@ class ModelChoiceField(forms.Field):
 
     yield ('', self.empty_label)
 
+    if self._cache_choices:
+      for choice in caching.getChoices(self.reference_class):
+        yield choice
+      return
 
     for inst in self._query:
       yield (inst.key(), unicode(inst))
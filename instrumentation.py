@@ -0,0 +1,166 @@
+"""
+Per-request instrumentation of admin handlers.
+Datastore RPCs are counted and timed with API proxy hooks, template
+rendering is timed by template_registry. Samples of finished requests
+are kept per route (handler method) in a rolling in-memory window of
+the process and summarized as percentiles on the /_stats/ admin page.
+"""
+import collections
+import math
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+from . import admin_settings
+
+# Datastore RPC names by call name, other calls are counted as 'other'
+RPC_NAMES = {
+    'Get': 'get',
+    'Put': 'put',
+    'Delete': 'delete',
+    'RunQuery': 'query',
+    'Next': 'query',
+    'Count': 'query',
+}
+RPC_KINDS = ('get', 'put', 'query', 'delete', 'other')
+
+PERCENTILES = (50, 95, 99)
+
+_HOOK_NAME = 'appengine_admin_instrumentation'
+
+# Record of the request served by current thread
+_local = threading.local()
+
+# route -> deque of samples of finished requests
+_samples = {}
+_samplesLock = threading.Lock()
+
+
+class RequestRecord(object):
+    """Measurements of one admin request.
+    """
+    def __init__(self, route):
+        self.route = route
+        self.start = time.time()
+        self.wall = 0.0
+        self.render = 0.0
+        self.rpcCalls = dict([(kind, 0) for kind in RPC_KINDS])
+        self.rpcTime = dict([(kind, 0.0) for kind in RPC_KINDS])
+        # id(request) -> (rpc kind, start time) of RPCs in flight
+        self.pending = {}
+
+
+def _preCall(service, call, request, response):
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record.pending[id(request)] = (RPC_NAMES.get(call, 'other'), time.time())
+
+
+def _postCall(service, call, request, response):
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return
+    kind, start = record.pending.pop(id(request), (RPC_NAMES.get(call, 'other'), None))
+    record.rpcCalls[kind] += 1
+    if start is not None:
+        record.rpcTime[kind] += time.time() - start
+
+
+def install():
+    """Installs datastore RPC hooks. Hooks measure admin requests only.
+    """
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append(_HOOK_NAME, _preCall, 'datastore_v3')
+    apiproxy.GetPostCallHooks().Append(_HOOK_NAME, _postCall, 'datastore_v3')
+
+
+def startRequest(route):
+    """Starts measuring request served by current thread.
+    """
+    _local.record = RequestRecord(route)
+
+
+def finishRequest():
+    """Stops measuring current request and adds it to the window.
+    """
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return
+    _local.record = None
+    record.wall = time.time() - record.start
+    record.pending = None
+    _samplesLock.acquire()
+    try:
+        samples = _samples.get(record.route)
+        if samples is None:
+            samples = collections.deque(maxlen = admin_settings.ADMIN_STATS_MAX_SAMPLES)
+            _samples[record.route] = samples
+        samples.append(record)
+    finally:
+        _samplesLock.release()
+
+
+def addRenderTime(seconds):
+    """Accounts template rendering time to current request.
+    """
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record.render += seconds
+
+
+def percentile(sortedValues, percent):
+    """Nearest-rank percentile of sorted values.
+    """
+    if not sortedValues:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sortedValues)))
+    return sortedValues[max(rank, 1) - 1]
+
+
+def _percentiles(values):
+    values = sorted(values)
+    return dict([('p%i' % percent, round(percentile(values, percent) * 1000.0, 1)) for percent in PERCENTILES])
+
+
+def summary():
+    """Returns per route summary of requests in the window:
+        route -> {'requests', 'wall', 'render', 'datastore', 'rpcs'}
+        where times are dicts of percentiles in milliseconds and rpcs maps
+        RPC kind to average calls per request and percentiles of its time.
+    """
+    since = time.time() - admin_settings.ADMIN_STATS_WINDOW
+    _samplesLock.acquire()
+    try:
+        windows = dict([(route, [record for record in samples if record.start >= since])
+            for route, samples in _samples.items()])
+    finally:
+        _samplesLock.release()
+    result = {}
+    for route, records in windows.items():
+        if not records:
+            continue
+        rpcs = {}
+        for kind in RPC_KINDS:
+            calls = sum([record.rpcCalls[kind] for record in records])
+            if calls:
+                rpcs[kind] = _percentiles([record.rpcTime[kind] for record in records])
+                rpcs[kind]['calls'] = round(float(calls) / len(records), 2)
+        result[route] = {
+            'requests': len(records),
+            'wall': _percentiles([record.wall for record in records]),
+            'render': _percentiles([record.render for record in records]),
+            'datastore': _percentiles([sum(record.rpcTime.values()) for record in records]),
+            'rpcs': rpcs,
+        }
+    return result
+
+
+def reset():
+    """Forgets all samples.
+    """
+    _samplesLock.acquire()
+    try:
+        _samples.clear()
+    finally:
+        _samplesLock.release()
@@ -0,0 +1,390 @@
+"""
+User selected options of the list view: filters set by ModelAdmin.listFilters
+and sort order chosen by clicking column headers.
+Options are turned into conditions and orders of the list view GQL query.
+"""
+import datetime
+import re
+import urllib
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import users
+from google.appengine.ext import db
+
+# Filter types of ModelAdmin.listFilters
+FILTER_TYPES = ('eq', 'range', 'in')
+
+# Prefix of filter parameters in list view url
+FILTER_PARAM_PREFIX = 'filter_'
+
+# Name of sort order parameter in list view url.
+# Value is field name, prefixed with '-' for descending order.
+SORT_PARAM = 'sort'
+
+# Max number of values of 'in' filter (datastore runs a query per value)
+MAX_IN_VALUES = 30
+
+_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+_GQL_CLAUSES = re.compile(r'^\s*(?:WHERE\s+(?P<where>.*?))?\s*(?:ORDER\s+BY\s+(?P<order>.*?))?\s*$', re.I | re.S)
+_GQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_GQL_INEQUALITY = re.compile(r'(\w+)\s*(?:<=|>=|!=|<|>)')
+_GQL_EQUALITY = re.compile(r'(\w+)\s*=|(\w+)\s+IN\b', re.I)
+
+# Errors of queries that the datastore refuses to run
+_QUERY_ERRORS = (
+    datastore_errors.BadArgumentError,
+    datastore_errors.BadFilterError,
+    datastore_errors.BadQueryError,
+    datastore_errors.BadRequestError,
+)
+
+
+def splitGql(gql):
+    """Splits listGql into WHERE conditions and ORDER BY orders.
+        Returns (conditions, orders) where conditions is GQL text or ''
+        and orders is list of (property name, 'ASC' or 'DESC').
+        Returns None if listGql has other clauses.
+    """
+    match = _GQL_CLAUSES.match(gql or '')
+    if match is None:
+        return None
+    orders = []
+    for order in (match.group('order') or '').split(','):
+        parts = order.split()
+        if not parts:
+            continue
+        direction = len(parts) > 1 and parts[1].upper() or 'ASC'
+        orders.append((parts[0], direction))
+    return (match.group('where') or '').strip(), orders
+
+
+def gqlInequalities(where):
+    """Returns set of property names used in inequality conditions
+        of GQL WHERE clause text.
+    """
+    return set(_GQL_INEQUALITY.findall(_GQL_STRING.sub("''", where or '')))
+
+
+def gqlEqualities(where):
+    """Returns set of property names used in equality or IN conditions
+        of GQL WHERE clause text.
+    """
+    names = set()
+    for name, inName in _GQL_EQUALITY.findall(_GQL_STRING.sub("''", where or '')):
+        names.add(name or inName)
+    return names
+
+
+def _parseDate(text):
+    for dateFormat in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, dateFormat)
+        except ValueError:
+            pass
+    raise ValueError('Date must look like YYYY-MM-DD or YYYY-MM-DD HH:MM')
+
+
+def parseValue(prop, text):
+    """Converts filter input text to datastore value of the property.
+        Raises ValueError if the text is not valid value.
+    """
+    if isinstance(prop, db.ListProperty):
+        valueType = prop.item_type
+    elif isinstance(prop, db.ReferenceProperty):
+        valueType = db.Key
+    else:
+        valueType = prop.data_type
+    text = text.strip()
+    if valueType is db.Key:
+        try:
+            return db.Key(text)
+        except (datastore_errors.BadKeyError, datastore_errors.BadArgumentError):
+            raise ValueError('Not a valid key')
+    if valueType is bool:
+        if text.lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if text.lower() in ('0', 'false', 'no', 'off'):
+            return False
+        raise ValueError('Boolean value must be true or false')
+    if valueType in (int, long):
+        return int(text)
+    if valueType is float:
+        return float(text)
+    if valueType is datetime.datetime:
+        return _parseDate(text)
+    if valueType is datetime.date:
+        return _parseDate(text).date()
+    if valueType is users.User:
+        return users.User(text)
+    if valueType in (db.Text, db.Blob):
+        raise ValueError('Property is not indexed')
+    return unicode(text)
+
+
+class ListFilter(object):
+    """One filter of the list view as shown in filter form.
+    """
+    def __init__(self, modelAdmin, fieldName, filterType = 'eq'):
+        if filterType not in FILTER_TYPES:
+            raise ValueError("Unknown filter type '%s' of field '%s'" % (filterType, fieldName))
+        self.name = fieldName
+        self.prop = getattr(modelAdmin.model, fieldName)
+        self.type = filterType
+        self.verbose_name = getattr(self.prop, 'verbose_name', None) or fieldName
+        self.param = FILTER_PARAM_PREFIX + fieldName
+        self.choices = None
+        if filterType == 'eq' and getattr(self.prop, 'choices', None):
+            self.choices = [(unicode(choice), unicode(choice)) for choice in self.prop.choices]
+        elif filterType == 'eq' and isinstance(self.prop, db.BooleanProperty):
+            self.choices = [(u'true', u'Yes'), (u'false', u'No')]
+        self.value = u''
+        self.valueFrom = u''
+        self.valueTo = u''
+
+    def params(self):
+        """Returns names of url parameters of the filter.
+        """
+        if self.type == 'range':
+            return [self.param + '_from', self.param + '_to']
+        return [self.param]
+
+    def conditions(self, request, errors):
+        """Reads filter values from request. Returns list of
+            (property name, operator, value) conditions.
+            Invalid values are reported in errors list.
+        """
+        conditions = []
+        try:
+            if self.type == 'range':
+                self.valueFrom = request.get(self.param + '_from', u'')
+                self.valueTo = request.get(self.param + '_to', u'')
+                if self.valueFrom.strip():
+                    conditions.append((self.prop.name, '>=', parseValue(self.prop, self.valueFrom)))
+                if self.valueTo.strip():
+                    conditions.append((self.prop.name, '<=', parseValue(self.prop, self.valueTo)))
+            else:
+                self.value = request.get(self.param, u'')
+                if not self.value.strip():
+                    return []
+                if self.type == 'in':
+                    values = [parseValue(self.prop, value) for value in self.value.split(',') if value.strip()]
+                    if len(values) > MAX_IN_VALUES:
+                        raise ValueError('At most %i values are allowed' % MAX_IN_VALUES)
+                    conditions.append((self.prop.name, 'IN', values))
+                else:
+                    conditions.append((self.prop.name, '=', parseValue(self.prop, self.value)))
+        except (ValueError, datastore_errors.Error), exc:
+            errors.append(u'%s: %s' % (self.verbose_name, exc))
+            return []
+        return conditions
+
+
+class ListColumn(object):
+    """Column header of the list view.
+        sortParam is value of sort parameter for the header link
+        or None if the column is not sortable.
+        direction is 'asc' or 'desc' if the list is sorted by the column.
+    """
+    def __init__(self, prop, sortParam, direction):
+        self.property = prop
+        self.sortParam = sortParam
+        self.direction = direction
+
+
+class ListOptions(object):
+    """Filters and sort order of the list view read from request.
+        Use gql() for the list view query and queryString() for
+        carrying the options over to paging links.
+        errors holds messages about invalid filter values and
+        filter or sort combinations the datastore can not serve.
+    """
+    def __init__(self, modelAdmin, request):
+        self.modelAdmin = modelAdmin
+        self.filters = [ListFilter(modelAdmin, name, filterType) for name, filterType in modelAdmin._listFilters]
+        self.errors = []
+        self.conditions = []
+        for listFilter in self.filters:
+            self.conditions.extend(listFilter.conditions(request, self.errors))
+        self._params = []
+        for listFilter in self.filters:
+            for param in listFilter.params():
+                value = request.get(param, u'')
+                if value.strip():
+                    self._params.append((param, value.encode('utf-8')))
+        # Sort order chosen by user: field name as given in url and
+        # (datastore property name, direction) used in the query
+        self.sort = request.get(SORT_PARAM, u'')
+        self.order = None
+        if self.sort:
+            fieldName = self.sort.lstrip('-')
+            if fieldName in modelAdmin._sortableFields:
+                self.order = (getattr(modelAdmin.model, fieldName).name, self.sort.startswith('-') and 'DESC' or 'ASC')
+            else:
+                self.errors.append(u'List can not be sorted by %s' % fieldName)
+                self.sort = u''
+        if self.conditions or self.order:
+            self._validate()
+
+    @property
+    def active(self):
+        """Tells if the list is narrowed by filters.
+        """
+        return bool(self.conditions)
+
+    def filterQueryString(self):
+        """Returns url encoded filter parameters followed by '&' or ''.
+        """
+        if not self._params:
+            return ''
+        return urllib.urlencode(self._params) + '&'
+
+    def queryString(self):
+        """Returns url encoded filter and sort parameters followed by '&' or ''.
+        """
+        if not self.sort:
+            return self.filterQueryString()
+        return self.filterQueryString() + urllib.urlencode([(SORT_PARAM, self.sort.encode('utf-8'))]) + '&'
+
+    def columns(self):
+        """Returns ListColumn for every list field.
+        """
+        columns = []
+        for prop in self.modelAdmin._listProperties:
+            sortParam = None
+            direction = None
+            if prop.name in self.modelAdmin._sortableFields:
+                sortParam = prop.name
+                if self.sort == prop.name:
+                    direction = 'asc'
+                    sortParam = '-' + prop.name
+                elif self.sort == '-' + prop.name:
+                    direction = 'desc'
+            columns.append(ListColumn(prop, sortParam, direction))
+        return columns
+
+    def _inequalities(self):
+        """Returns set of properties with inequality conditions
+            of filters and listGql.
+        """
+        inequalities = set([name for name, operator, value in self.conditions if operator not in ('=', 'IN')])
+        if self.modelAdmin._listGqlParts is not None:
+            inequalities.update(gqlInequalities(self.modelAdmin._listGqlParts[0]))
+        return inequalities
+
+    def _inequality(self):
+        for name, operator, value in self.conditions:
+            if operator not in ('=', 'IN'):
+                return name
+        inequalities = self._inequalities()
+        return inequalities and sorted(inequalities)[0] or None
+
+    def orders(self):
+        """Returns (property name, direction) orders of the query.
+            Sort order chosen by user replaces listGql orders.
+            Datastore needs the property of range filter or listGql
+            inequality sorted first.
+        """
+        if self.order is None:
+            return self.modelAdmin._listGqlParts[1]
+        inequality = self._inequality()
+        if inequality and inequality != self.order[0]:
+            return [(inequality, 'ASC'), self.order]
+        return [self.order]
+
+    def gql(self):
+        """Returns (GQL clauses, named parameters) for the list view query:
+            listGql combined with filter conditions and sort order.
+        """
+        if not self.conditions and self.order is None:
+            return self.modelAdmin.listGql, {}
+        where = self.modelAdmin._listGqlParts[0]
+        orders = self.orders()
+        parts = where and [where] or []
+        params = {}
+        for number, (name, operator, value) in enumerate(self.conditions):
+            parts.append('%s %s :f%i' % (name, operator, number))
+            params['f%i' % number] = value
+        gql = parts and 'WHERE ' + ' AND '.join(parts) or ''
+        if orders:
+            gql += ' ORDER BY ' + ', '.join(['%s %s' % order for order in orders])
+        return gql, params
+
+    def indexProperties(self):
+        """Returns (property name, direction) list of composite index needed
+            by the query or None if built-in indexes are enough.
+        """
+        orders = self.orders()
+        equalities = []
+        for name, operator, value in self.conditions:
+            if operator in ('=', 'IN') and name not in equalities:
+                equalities.append(name)
+        inequality = self._inequality()
+        if not orders and (inequality is None or not equalities):
+            # merge join of equality filters or inequality on one property
+            return None
+        if not equalities and len(orders) == 1 and inequality in (None, orders[0][0]):
+            # single property index
+            return None
+        properties = [(name, 'ASC') for name in equalities]
+        if inequality and (not orders or orders[0][0] != inequality):
+            properties.append((inequality, 'ASC'))
+        properties.extend([order for order in orders if order[0] not in equalities])
+        return properties
+
+    def _validate(self):
+        """Reports filter and sort combinations that can not be served by the
+            datastore before the list query is run. Filters and sort order
+            are dropped in that case.
+        """
+        if self.modelAdmin._listGqlParts is None:
+            self.errors.append(u'Filters and sorting can not be combined with listGql of this model')
+            self.conditions = []
+            self.order = None
+            self.sort = u''
+            return
+        where, orders = self.modelAdmin._listGqlParts
+        inequalities = self._inequalities()
+        if len(inequalities) > 1:
+            self.errors.append(u'Range filter can be used on one field at a time')
+        elif inequalities and self.order is None and orders and orders[0][0] not in inequalities:
+            self.errors.append(u'Range filter can be used only on field %s that sorts the list' % orders[0][0])
+        else:
+            properties = self.indexProperties()
+            if properties is None and not where:
+                return
+            # Equalities of listGql are not analyzed, the query tells if it needs an index
+            try:
+                indexError = self._indexError()
+            except _QUERY_ERRORS, exc:
+                self.errors.append(u'Filters and sorting can not be combined with listGql of this model: %s' % exc)
+            else:
+                if indexError is None:
+                    return
+                if properties is None:
+                    self.errors.append(u'Filters and sorting need composite index that is not built: %s' % indexError)
+                else:
+                    self.errors.append(u'Filters and sorting need composite index that is not built. Add to index.yaml:\n%s' %
+                        self.indexYaml(properties))
+        self.conditions = []
+        self.order = None
+        self.sort = u''
+
+    def _indexError(self):
+        """Runs keys-only query for one item to find out if the index exists.
+            Returns error message if it does not. Other query errors are raised.
+        """
+        gql, params = self.gql()
+        try:
+            db.GqlQuery('SELECT __key__ FROM %s %s' % (self.modelAdmin.modelName, gql), **params).get()
+        except datastore_errors.NeedIndexError, exc:
+            return unicode(exc)
+        return None
+
+    def indexYaml(self, properties):
+        lines = ['- kind: %s' % self.modelAdmin.modelName, '  properties:']
+        for name, direction in properties:
+            lines.append('  - name: %s' % name)
+            if direction == 'DESC':
+                lines.append('    direction: desc')
+        return '\n'.join(lines)
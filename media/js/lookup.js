@@ -0,0 +1,62 @@
+// Lazy loading of reference field choices.
+// Select boxes of ModelAdmin.lookupFields contain only selected items,
+// other items are searched by label prefix with lookup_get view.
+
+var AdminLookup = {
+    delay: 300,
+    timers: {},
+    state: {},
+
+    search: function(input, selectId, url) {
+        if (AdminLookup.timers[selectId]) {
+            clearTimeout(AdminLookup.timers[selectId]);
+        }
+        AdminLookup.timers[selectId] = setTimeout(function() {
+            AdminLookup.state[selectId] = {url: url, q: input.value, cursor: null, link: input.parentNode.getElementsByTagName('a')[0]};
+            AdminLookup.load(selectId, false);
+        }, AdminLookup.delay);
+    },
+
+    more: function(selectId) {
+        AdminLookup.load(selectId, true);
+        return false;
+    },
+
+    load: function(selectId, append) {
+        var state = AdminLookup.state[selectId];
+        var url = state.url + '&q=' + encodeURIComponent(state.q);
+        if (append && state.cursor) {
+            url += '&cursor=' + encodeURIComponent(state.cursor);
+        }
+        var request = new XMLHttpRequest();
+        request.open('GET', url, true);
+        request.onreadystatechange = function() {
+            if (request.readyState != 4 || request.status != 200) {
+                return;
+            }
+            var result = JSON.parse(request.responseText);
+            AdminLookup.update(document.getElementById(selectId), result.items, append);
+            state.cursor = result.cursor;
+            state.link.style.display = result.cursor ? '' : 'none';
+        };
+        request.send(null);
+    },
+
+    update: function(select, items, append) {
+        var present = {};
+        // keep empty and selected options, drop previous search results
+        for (var i = select.options.length - 1; i >= 0; i--) {
+            var option = select.options[i];
+            if (!append && option.value && !option.selected) {
+                select.remove(i);
+            } else {
+                present[option.value] = true;
+            }
+        }
+        for (var i = 0; i < items.length; i++) {
+            if (!present[items[i][0]]) {
+                select.options[select.options.length] = new Option(items[i][1], items[i][0]);
+            }
+        }
+    }
+};
@@ -1,5 +1,6 @@
 import logging
 import copy
+import itertools
 
 from google.appengine.api import datastore_errors
 from google.appengine.ext import db
@@ -12,6 +13,10 @@ except ImportError:
         from django.utils.encoding import smart_unicode
 
 from . import admin_forms
+from . import admin_settings
+from . import counters
+from . import db_extensions
+from . import list_options
 from . import utils
 from .utils import Http404
 
@@ -26,6 +31,8 @@ class PropertyWrapper(object):
         # Line like this could cause the exception: field.reference_class.kind
         if self.typeName == 'ReferenceProperty':
             self.reference_kind = prop.reference_class.kind()
+        # Blob values are shown as download links
+        self.isBlob = self.typeName in ('BlobProperty', 'ChunkedBlobProperty')
         # This might fail in case if prop is instancemethod
         self.verbose_name = getattr(prop, 'verbose_name', self.name)
         # set verbose_name to at least something represenative
@@ -48,18 +55,63 @@ class ModelAdmin(object):
         editFields - list of field names that that should be used as editable fields in admin interface
         readonlyFields - list of field names that should be used as read-only fields in admin interface
         listGql - GQL statement for record ordering/filtering/whatever_else in list view
+        listPaging - 'cursor' (default) for datastore cursor paging in list view or
+            'offset' for paging with "LIMIT offset, n" GQL clause
+        listCount - how list view gets total number of items:
+            'query' (default) - count query on every request;
+            'stats' - datastore statistics (updated about once a day);
+            'memcache' - count query cached in memcache;
+            'sharded' - sharded counter maintained by admin site writes;
+            'none' - do not count, show page number only;
+            or counters.CountProvider instance
+        listProjection - if True list view reads only listFields from datastore:
+            with a projection query if all list fields other than blobs are indexed
+            single value properties, otherwise with a keys-only query and
+            a batched get of current page items.
+            Blob fields are not read by the projection query; whether a blob is
+            uploaded and its meta info are kept in memcache and items missing
+            there are loaded once with a batched get.
+            Projection of more than one property needs a composite index.
+        lookupFields - dict of ReferenceProperty or ManyToManyProperty field names
+            mapped to a property name of referenced model, e.g. {'customer': 'name'}.
+            Edit form of these fields renders only selected items and
+            searches others by prefix of the given property on demand.
+            Use it when referenced model has too many items for a dropdown box.
+        listCache - time in seconds for keeping rendered item rows and paging of
+            list view pages in memcache, 0 (default) disables the cache.
+            Cached pages are dropped when items are changed through admin site,
+            changes made elsewhere show up when the time expires.
+        listFilters - fields that list view can be filtered by. Items are field names
+            for equality filters or (field name, filter type) pairs where filter type is
+            'eq' (equality), 'range' (from - to) or 'in' (comma separated values).
+            Fields must be indexed. Filters are combined with listGql conditions;
+            filter combinations that need a composite index which is not built
+            are reported in list view.
+            List view columns of indexed single value properties can be sorted
+            by clicking the header; the chosen order replaces listGql ORDER BY.
+        searchFields - StringProperty, TextProperty or StringListProperty fields
+            indexed for full-text search in list view. Items saved before the
+            fields were set are indexed with "Rebuild search index" of list view.
     """
     model = None
     listFields = ()
     editFields = ()
     readonlyFields = ()
     listGql = ''
+    listPaging = 'cursor'
+    listCount = 'query'
+    listProjection = False
+    lookupFields = {}
+    listCache = 0
+    listFilters = ()
+    searchFields = ()
     AdminForm = None
 
     def __init__(self):
         super(ModelAdmin, self).__init__()
         # Cache model name as string
         self.modelName = str(self.model.kind())
+        self.countProvider = counters.getCountProvider(self.listCount)
         self._listProperties = []
         self._editProperties = []
         self._readonlyProperties = []
@@ -67,40 +119,246 @@ class ModelAdmin(object):
         self._extractProperties(self.listFields, self._listProperties)
         self._extractProperties(self.editFields, self._editProperties)
         self._extractProperties(self.readonlyFields, self._readonlyProperties)
+        # All model properties except blob meta info fields (used for export)
+        self._allProperties = []
+        self._extractProperties(self._modelPropertyNames(), self._allProperties)
+        # Blob fields can not be set for many items at once
+        self._bulkEditProperties = [prop for prop in self._editProperties if not prop.isBlob]
+        # Deleting items of models with chunked blobs needs loading entities
+        self.hasChunkedBlobs = any([
+            isinstance(prop, db_extensions.ChunkedBlobProperty)
+            for prop in self.model.properties().values()
+        ])
+        # (field name, filter type) pairs of list view filters
+        self._listFilters = []
+        for spec in self.listFilters:
+            if isinstance(spec, basestring):
+                spec = (spec, 'eq')
+            # fails early on unknown fields and filter types
+            list_options.ListFilter(self, *spec)
+            self._listFilters.append(tuple(spec))
+        # List fields that the datastore can sort by
+        self._sortableFields = set([prop.name for prop in self._listProperties if self._isSortable(prop.prop)])
+        # WHERE conditions and ORDER BY orders of listGql for adding filters
+        self._listGqlParts = list_options.splitGql(self.listGql)
+        # Datastore names of properties for list view projection query
+        self._projectedFields = None
+        if self.listProjection:
+            self._projectedFields = self._getProjectedFields()
+        # Properties of listGql equality conditions can not be projected
+        self._listGqlEqualities = list_options.gqlEqualities(self.listGql)
         if self.AdminForm is None:
             self.AdminForm = admin_forms.createAdminForm(
                 formModel = self.model,
                 editFields = self.editFields,
-                editProps = self._editProperties
+                editProps = self._editProperties,
+                lookupFields = self.lookupFields.keys()
             )
+        if self.searchFields:
+            # Items are indexed when AdminForm saves them
+            self.AdminForm.searchFields = tuple(self.searchFields)
+
+    def getLookupQuery(self, fieldName, prefix = u''):
+        """Returns query of items that can be referenced by lookup field
+            ordered by the label property and matching given label prefix.
+            Raises Http404 if the field is not in lookupFields.
+        """
+        if fieldName not in self.lookupFields:
+            raise Http404()
+        labelName = self.lookupFields[fieldName]
+        query = getattr(self.model, fieldName).reference_class.all()
+        if prefix:
+            query.filter('%s >=' % labelName, prefix)
+            query.filter('%s <' % labelName, prefix + u'\ufffd')
+        return query.order(labelName)
 
     def _extractProperties(self, fieldNames, storage):
         for propertyName in fieldNames:
             storage.append(PropertyWrapper(getattr(self.model, propertyName), propertyName))
 
-    def _attachListFields(self, item):
+    def _modelPropertyNames(self):
+        """Returns names of model properties in definition order
+            except the fields that hold blob meta info.
+        """
+        properties = sorted(self.model.properties().items(), key = lambda item: item[1].creation_counter)
+        names = [name for name, prop in properties]
+        metaNames = [
+            name + admin_settings.BLOB_FIELD_META_SUFFIX for name, prop in properties
+            if isinstance(prop, (db.BlobProperty, db_extensions.ChunkedBlobProperty))
+        ]
+        return [name for name in names if name not in metaNames]
+
+    @staticmethod
+    def _isProjectable(prop):
+        """Tells if property value can be read from a projection query.
+        """
+        return (isinstance(prop, db.Property)
+            and getattr(prop, 'indexed', True)
+            and not isinstance(prop, (db.ListProperty, db.TextProperty, db.BlobProperty, db.UserProperty)))
+
+    @staticmethod
+    def _isSortable(prop):
+        """Tells if list view can be sorted by the property with an indexed query.
+        """
+        return (isinstance(prop, db.Property)
+            and getattr(prop, 'indexed', True)
+            and not isinstance(prop, (db.ListProperty, db.TextProperty, db.BlobProperty, db_extensions.ChunkedBlobProperty)))
+
+    def _getProjectedFields(self):
+        """Returns datastore names of properties needed for displaying list fields
+            or None if some of list fields can not be read from a projection query.
+            Blob fields are not projected, see utils.getListBlobInfo().
+        """
+        fields = []
+        for prop in self._listProperties:
+            if prop.isBlob:
+                continue
+            if not self._isProjectable(prop.prop):
+                logging.info("List field '%s' of model '%s' can not be projected" % (prop.name, self.modelName))
+                return None
+            if prop.prop.name not in fields:
+                fields.append(prop.prop.name)
+        return fields or None
+
+    def listQuery(self, gqlSuffix = '', listOptions = None):
+        """Returns GqlQuery for list view. gqlSuffix is appended to listGql
+            that is combined with filters of listOptions if given.
+            With listProjection the query returns either projected entities
+            or keys that are resolved by iterListFields().
+        """
+        gql, params = self.listGql, {}
+        if listOptions is not None:
+            gql, params = listOptions.gql()
+        if not self.listProjection:
+            return self.model.gql(gql + gqlSuffix, **params)
+        if self._projectedFields and not self._isProjectionFiltered(listOptions):
+            select = ', '.join(self._projectedFields)
+        else:
+            select = '__key__'
+        return db.GqlQuery('SELECT %s FROM %s %s%s' % (select, self.modelName, gql, gqlSuffix), **params)
+
+    def _isProjectionFiltered(self, listOptions):
+        """Tells if some projected property is in equality or IN condition
+            of listGql or filters. Datastore can not project such properties
+            so the list is read with keys-only query then.
+        """
+        equalities = set(self._listGqlEqualities)
+        if listOptions is not None:
+            equalities.update([name for name, operator, value in listOptions.conditions if operator in ('=', 'IN')])
+        return bool(equalities.intersection(self._projectedFields))
+
+    def listKeysQuery(self):
+        """Returns keys-only GqlQuery for all items matched by listGql.
+        """
+        return db.GqlQuery('SELECT __key__ FROM %s %s' % (self.modelName, self.listGql))
+
+    def _startListFields(self, items):
+        """Starts attaching property instances for list fields to the items.
+            Entities referenced by ReferenceProperty and ManyToManyProperty
+            list fields are requested with one batched get that is not waited for.
+            Returns function that waits for the get and returns the items
+            with list fields attached.
+        """
+        items = list(items)
+        blobInfo = None
+        if items and isinstance(items[0], db.Key):
+            # Keys-only projection query. Fetch the items of this page only.
+            items = [item for item in db.get(items) if item is not None]
+        elif items and self._projectedFields:
+            # Projected items have no blob fields
+            blobFields = [prop.name for prop in self._listProperties if prop.isBlob]
+            if blobFields:
+                blobInfo = utils.getListBlobInfo([item.key() for item in items], blobFields)
+        referenceKeys = set()
+        for prop in self._listProperties:
+            if prop.typeName == 'ReferenceProperty':
+                for item in items:
+                    key = prop.prop.get_value_for_datastore(item)
+                    if key is not None:
+                        referenceKeys.add(key)
+            elif prop.typeName == 'ManyToManyProperty':
+                for item in items:
+                    referenceKeys.update(getattr(item, prop.name) or [])
+        referenceKeys = list(referenceKeys)
+        rpc = None
+        if referenceKeys:
+            rpc = db.get_async(referenceKeys)
+
+        def finish():
+            referenced = {}
+            if rpc is not None:
+                # Missing entities are returned as None.
+                referenced = dict(zip(referenceKeys, rpc.get_result()))
+            # key -> label mapping shared by all rows of the page
+            labels = {}
+            for key, entity in referenced.iteritems():
+                labels[key] = smart_unicode(entity)
+            for item in items:
+                self._attachItemListFields(item, referenced, labels, blobInfo)
+            return items
+        return finish
+
+    def iterListFields(self, items, batchSize = admin_settings.ADMIN_LIST_ROW_BATCH):
+        """Returns iterator of items of the page with list fields attached.
+            References are fetched for batchSize items at once. The first
+            batch is read and its references are requested before this
+            returns, so that the get runs while the caller renders the page
+            around the rows; references of every next batch are requested
+            before rows of the previous batch are handed out.
+        """
+        items = iter(items)
+        batch = list(itertools.islice(items, batchSize))
+        started = batch and self._startListFields(batch) or None
+        return self._iterListFields(items, batchSize, started)
+
+    def _iterListFields(self, items, batchSize, pending):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batchSize:
+                started = self._startListFields(batch)
+                batch = []
+                if pending is not None:
+                    for attached in pending():
+                        yield attached
+                pending = started
+        started = batch and self._startListFields(batch) or None
+        for finish in (pending, started):
+            if finish is not None:
+                for attached in finish():
+                    yield attached
+
+    def _attachItemListFields(self, item, referenced, labels, blobInfo = None):
         """Attaches property instances for list fields to given data entry.
-            This is used in Admin class view methods.
+            referenced - key -> entity mapping for ReferenceProperty values
+            labels - key -> label mapping for ManyToManyProperty values
+            blobInfo - (key, field name) -> (uploaded, meta info) mapping for
+                blob fields of projected items, None for full entities
         """
         item.listProperties = copy.deepcopy(self._listProperties[:])
         for prop in item.listProperties:
             try:
-                prop.value = getattr(item, prop.name)
-                if prop.typeName == 'BlobProperty':
+                if prop.typeName == 'ReferenceProperty':
+                    # Dangling reference is shown as None
+                    prop.value = referenced.get(prop.prop.get_value_for_datastore(item))
+                elif prop.isBlob and blobInfo is not None:
+                    # Blob is not projected
+                    uploaded, prop.meta = blobInfo.get((item.key(), prop.name), (False, None))
+                    prop.value = uploaded or None
+                elif prop.typeName == 'ManyToManyProperty':
+                    # Show pretty list of referenced items.
+                    # Show 'None' in place of missing items
+                    prop.value = ', '.join([labels.get(key, u'None') for key in getattr(item, prop.name) or []])
+                else:
+                    prop.value = getattr(item, prop.name)
+                if prop.isBlob and blobInfo is None:
                     prop.meta = utils.getBlobProperties(item, prop.name)
                     if prop.value:
                         prop.value = True # release the memory
-                if prop.typeName == 'ManyToManyProperty':
-                    # Show pretty list of referenced items.
-                    # Show 'None' in place of missing items
-                    new_value_list = []
-                    for key in prop.value:
-                        new_value_list.append(smart_unicode(db.get(key)))
-                    prop.value = ', '.join(new_value_list)
             except datastore_errors.Error, exc:
                 # Error is raised if referenced property is deleted
                 # Catch the exception and set value to none
-                logging.warning('Error catched in ModelAdmin._attachListFields: %s' % exc)
+                logging.warning('Error catched in ModelAdmin._attachItemListFields: %s' % exc)
                 prop.value = None
             # convert the value to unicode for displaying in list view
             if hasattr(prop.value, '__call__'):
@@ -112,6 +370,8 @@ class ModelAdmin(object):
 
 # holds model_name -> ModelAdmin_instance mapping.
 _modelRegister = {}
+# Sorted list of registered model names. Reset by register().
+_sortedModelNames = None
 
 def register(*args):
     """Registers ModelAdmin instance for corresponding model.
@@ -119,10 +379,22 @@ def register(*args):
         In case if more ModelAdmin instances with same model are registered
         last registered instance will be the active one.
     """
+    global _sortedModelNames
     for modelAdminClass in args:
         modelAdminInstance = modelAdminClass()
         _modelRegister[modelAdminInstance.modelName] = modelAdminInstance
         logging.info("Registering AdminModel '%s' for model '%s'" % (modelAdminClass.__name__, modelAdminInstance.modelName))
+    _sortedModelNames = None
+
+def getModelNames():
+    """Returns sorted list of registered model names.
+        The list is built once after registration and shared by all requests
+        so it must not be modified.
+    """
+    global _sortedModelNames
+    if _sortedModelNames is None:
+        _sortedModelNames = sorted(_modelRegister.keys())
+    return _sortedModelNames
 
 def getModelAdmin(modelName):
     """Get ModelAdmin instance for particular model by model name (string).
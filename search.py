@@ -0,0 +1,232 @@
+"""
+Full-text search of admin models with ModelAdmin.searchFields.
+Inverted index keeps a posting list (keys of items that contain the word)
+for every word of every model. Postings are updated when items are saved
+or deleted through admin site; rebuildIndex is used for existing data.
+"""
+import logging
+import re
+
+from google.appengine.ext import db
+
+from . import admin_settings
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+# Longer words are not indexed (they would not fit in posting key names)
+_MAX_WORD = 100
+
+# Max number of entities of one datastore call
+_MAX_BATCH = 500
+# Max estimated size of posting lists written by one datastore call
+_MAX_BATCH_BYTES = 1000000
+
+
+class SearchPosting(db.Model):
+    """Posting list of one word.
+        Key name: "<model name>:<word>".
+        Words that occur in more than admin_settings.ADMIN_SEARCH_MAX_POSTINGS
+        items are marked as overflow and are not used for searching.
+    """
+    keys = db.ListProperty(db.Key, indexed = False)
+    overflow = db.BooleanProperty(default = False, indexed = False)
+
+    @classmethod
+    def kind(cls):
+        return '_AdminSearchPosting'
+
+
+class SearchItem(db.Model):
+    """Words indexed for one item. Used for finding postings
+        to update when the item changes or is deleted.
+        Key name: item key as string.
+    """
+    words = db.StringListProperty(indexed = False)
+
+    @classmethod
+    def kind(cls):
+        return '_AdminSearchItem'
+
+
+def tokenize(text):
+    """Returns set of lower case words of the text.
+    """
+    if not text:
+        return set()
+    if not isinstance(text, unicode):
+        text = unicode(text, 'utf-8', 'replace')
+    return set([
+        word for word in _WORD.findall(text.lower())
+        if admin_settings.ADMIN_SEARCH_MIN_WORD <= len(word) <= _MAX_WORD
+    ])
+
+
+def itemWords(searchFields, item):
+    """Returns set of words in searchFields of the item.
+    """
+    words = set()
+    for fieldName in searchFields:
+        value = getattr(item, fieldName, None)
+        if isinstance(value, (list, tuple)):
+            for element in value:
+                words.update(tokenize(element))
+        else:
+            words.update(tokenize(value))
+    return words
+
+
+def _postingKeyName(kind, word):
+    return u'%s:%s' % (kind, word)
+
+
+def _slices(entities):
+    """Splits postings or search items into lists that fit in one datastore
+        call. Size of an entity is estimated from keys or words it holds.
+    """
+    batch = []
+    size = 0
+    for entity in entities:
+        if isinstance(entity, SearchPosting):
+            entitySize = sum([len(str(key)) for key in entity.keys])
+        else:
+            entitySize = sum([len(word) for word in entity.words])
+        entitySize += 100
+        if batch and (len(batch) == _MAX_BATCH or size + entitySize > _MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(entity)
+        size += entitySize
+    if batch:
+        yield batch
+
+
+def _getByKeyNames(model, keyNames):
+    """Batched get_by_key_name in calls of at most _MAX_BATCH keys.
+    """
+    entities = []
+    for start in range(0, len(keyNames), _MAX_BATCH):
+        entities.extend(model.get_by_key_name(keyNames[start:start + _MAX_BATCH]))
+    return entities
+
+
+def _put(entities):
+    for batch in _slices(entities):
+        db.put(batch)
+
+
+def _delete(entities):
+    for start in range(0, len(entities), _MAX_BATCH):
+        db.delete(entities[start:start + _MAX_BATCH])
+
+
+def _updatePostings(kind, additions, removals):
+    """Adds and removes item keys of posting lists with batched gets and puts.
+        additions, removals - word -> set of item keys
+        Postings are not updated in transactions so concurrent writes of items
+        sharing a word may lose a key; rebuildIndex repairs it.
+    """
+    words = list(set(additions.keys()) | set(removals.keys()))
+    if not words:
+        return
+    postings = _getByKeyNames(SearchPosting, [_postingKeyName(kind, word) for word in words])
+    changed = []
+    empty = []
+    for word, posting in zip(words, postings):
+        if posting is None:
+            if word not in additions:
+                continue
+            posting = SearchPosting(key_name = _postingKeyName(kind, word))
+        if posting.overflow:
+            continue
+        keys = set(posting.keys)
+        keys.difference_update(removals.get(word, ()))
+        keys.update(additions.get(word, ()))
+        if not keys:
+            if posting.is_saved():
+                empty.append(posting)
+            continue
+        if len(keys) > admin_settings.ADMIN_SEARCH_MAX_POSTINGS:
+            logging.info("Word '%s' of model '%s' is too common for search index" % (word, kind))
+            posting.overflow = True
+            keys = set()
+        posting.keys = sorted(keys)
+        changed.append(posting)
+    _put(changed)
+    _delete(empty)
+
+
+def indexItems(searchFields, items):
+    """Updates search index for saved items of the same model.
+        Only words that were added or removed since last indexing are written.
+    """
+    if not searchFields or not items:
+        return
+    kind = items[0].kind()
+    records = _getByKeyNames(SearchItem, [str(item.key()) for item in items])
+    additions = {}
+    removals = {}
+    changedRecords = []
+    for item, record in zip(items, records):
+        key = item.key()
+        words = itemWords(searchFields, item)
+        oldWords = record and set(record.words) or set()
+        if record is not None and words == oldWords:
+            continue
+        for word in words - oldWords:
+            additions.setdefault(word, set()).add(key)
+        for word in oldWords - words:
+            removals.setdefault(word, set()).add(key)
+        changedRecords.append(SearchItem(key_name = str(key), words = sorted(words)))
+    _updatePostings(kind, additions, removals)
+    _put(changedRecords)
+
+
+def unindexKeys(keys):
+    """Removes deleted items of the same model from search index.
+    """
+    if not keys:
+        return
+    kind = keys[0].kind()
+    records = _getByKeyNames(SearchItem, [str(key) for key in keys])
+    removals = {}
+    for key, record in zip(keys, records):
+        if record is not None:
+            for word in record.words:
+                removals.setdefault(word, set()).add(key)
+    _updatePostings(kind, {}, removals)
+    _delete([record for record in records if record is not None])
+
+
+def search(kind, text):
+    """Returns keys of items of the model that contain all words of the text
+        in key order. Words that occur in too many items are ignored,
+        nothing is found if the text has no other words.
+    """
+    words = sorted(tokenize(text))
+    if not words:
+        return []
+    postings = SearchPosting.get_by_key_name([_postingKeyName(kind, word) for word in words])
+    if None in postings:
+        # some word is not found in any item
+        return []
+    lists = [posting.keys for posting in postings if not posting.overflow]
+    if not lists:
+        return []
+    # Intersect starting with the shortest posting list
+    lists.sort(key = len)
+    result = set(lists[0])
+    for keys in lists[1:]:
+        result.intersection_update(keys)
+        if not result:
+            break
+    return sorted(result)
+
+
+def rebuildIndex(searchFields, keys):
+    """Indexes items with given keys. Used in batches for indexing existing data.
+        Returns number of indexed items.
+    """
+    items = [item for item in db.get(keys) if item is not None]
+    indexItems(searchFields, items)
+    return len(items)
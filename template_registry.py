@@ -0,0 +1,70 @@
+"""
+Registry of compiled admin templates.
+Templates are loaded and compiled once per process and rendered
+straight into the response instead of being looked up by path
+on every request.
+"""
+import logging
+import os.path
+import time
+
+from google.appengine.ext.webapp import template
+from django.template import Context
+from django.template import TemplateDoesNotExist
+
+from . import admin_settings
+from . import instrumentation
+
+# Templates compiled when admin site is loaded
+PRELOADED_TEMPLATES = (
+    'index.html',
+    'model_item_list.html',
+    'model_item_list_row.html',
+    'model_item_list_paging.html',
+    'model_item_edit.html',
+    '404.html',
+    '500.html',
+)
+
+# Compiled templates: full path -> template
+_templates = {}
+
+
+def getTemplate(name):
+    """Returns compiled template of given name from admin_settings.ADMIN_TEMPLATE_DIR.
+        Setting is read on every call so custom template directory may be
+        set any time before the first request.
+    """
+    path = os.path.join(admin_settings.ADMIN_TEMPLATE_DIR, name)
+    compiled = _templates.get(path)
+    if compiled is None:
+        logging.info("Compiling template '%s'" % path)
+        compiled = template.load(path)
+        _templates[path] = compiled
+    return compiled
+
+
+def preload():
+    """Compiles all frequently used templates. Templates missing in
+        custom template directory are reported and left to fail when used.
+    """
+    for name in PRELOADED_TEMPLATES:
+        try:
+            getTemplate(name)
+        except TemplateDoesNotExist:
+            logging.warning("Template '%s' not found in %s" % (name, admin_settings.ADMIN_TEMPLATE_DIR))
+
+
+def render(name, values):
+    """Returns rendered template.
+    """
+    start = time.time()
+    output = getTemplate(name).render(Context(values))
+    instrumentation.addRenderTime(time.time() - start)
+    return output
+
+
+def write(out, name, values):
+    """Renders template into file like object out (response.out).
+    """
+    out.write(render(name, values))
@@ -4,8 +4,15 @@ Some utilities
 import pickle
 import logging
 import math
+import hashlib
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.ext import db
 
 from . import admin_settings
+from . import counters
+from . import db_extensions
 
 def getBlobProperties(item, fieldName):
     props = getattr(item, fieldName + admin_settings.BLOB_FIELD_META_SUFFIX, None)
@@ -14,6 +21,112 @@ def getBlobProperties(item, fieldName):
     else:
         return None
 
+def blobHash(data):
+    """Returns content hash of blob used as its ETag.
+    """
+    return hashlib.md5(data).hexdigest()
+
+def _blobPropertiesCacheKey(key, fieldName):
+    return 'appengine_admin:blobmeta:%s:%s' % (key, fieldName)
+
+def getCachedBlobProperties(key, fieldName):
+    """Returns blob meta info cached by cacheBlobProperties() or None.
+        This allows checking blob ETag without loading the entity.
+    """
+    return memcache.get(_blobPropertiesCacheKey(key, fieldName))
+
+def cacheBlobProperties(key, fieldName, props):
+    memcache.set(_blobPropertiesCacheKey(key, fieldName), props, time = admin_settings.ADMIN_BLOB_META_CACHE_TIME)
+
+def _listBlobCacheKey(key, fieldName):
+    return 'appengine_admin:listblob:%s:%s' % (key, fieldName)
+
+def getListBlobInfo(keys, fieldNames):
+    """Returns (key, field name) -> (uploaded, meta info) mapping for blob
+        columns of list view items read by a projection query, which can not
+        read unindexed blob and meta info fields. Info is read from memcache;
+        items not found there are loaded with one batched get and their
+        info is cached for the following list pages.
+    """
+    cacheKeys = dict([
+        (_listBlobCacheKey(key, fieldName), (key, fieldName))
+        for key in keys for fieldName in fieldNames
+    ])
+    info = {}
+    if cacheKeys:
+        for cacheKey, value in memcache.get_multi(cacheKeys.keys()).items():
+            info[cacheKeys[cacheKey]] = value
+    missing = []
+    for key in keys:
+        if key not in missing and [fieldName for fieldName in fieldNames if (key, fieldName) not in info]:
+            missing.append(key)
+    if missing:
+        fresh = {}
+        for key, item in zip(missing, db.get(missing)):
+            if item is None:
+                continue
+            for fieldName in fieldNames:
+                value = (bool(getattr(item, fieldName, None)), getBlobProperties(item, fieldName))
+                info[(key, fieldName)] = value
+                fresh[_listBlobCacheKey(key, fieldName)] = value
+        memcache.set_multi(fresh, time = admin_settings.ADMIN_BLOB_META_CACHE_TIME)
+    return info
+
+def forgetBlobProperties(item):
+    """Removes cached meta info for all blob properties of given item.
+        Should be called whenever the item is changed or deleted.
+    """
+    forgetBlobPropertiesByKeys(item.__class__, [item.key()])
+
+def forgetBlobPropertiesByKeys(model, keys):
+    """Removes cached meta info for all blob properties of model items with given keys.
+    """
+    fieldNames = [
+        fieldName for fieldName, prop in model.properties().iteritems()
+        if isinstance(prop, (db.BlobProperty, db_extensions.ChunkedBlobProperty))
+    ]
+    cacheKeys = [
+        cacheKey(key, fieldName)
+        for cacheKey in (_blobPropertiesCacheKey, _listBlobCacheKey)
+        for key in keys for fieldName in fieldNames
+    ]
+    if cacheKeys:
+        memcache.delete_multi(cacheKeys)
+
+class RangeNotSatisfiable(Exception):
+    code = 416
+
+def parseByteRange(rangeHeader, size):
+    """Parses HTTP Range header with single byte range such as "bytes=0-499",
+        "bytes=500-" or "bytes=-500" for content of given size.
+        Returns (first, last) byte positions (inclusive) or None if the header
+        should be ignored (it is malformed or asks for several ranges).
+        Raises RangeNotSatisfiable if range starts beyond the content.
+    """
+    unit, _, byteRange = rangeHeader.partition('=')
+    if unit.strip() != 'bytes' or ',' in byteRange:
+        return None
+    first, _, last = byteRange.strip().partition('-')
+    try:
+        if not first:
+            # suffix range: last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        first = int(first)
+        if last:
+            last = int(last)
+        else:
+            last = size - 1
+    except ValueError:
+        return None
+    if first > last:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    return first, min(last, size - 1)
+
 class Http404(Exception):
     code = 404
 
@@ -21,38 +134,242 @@ class Http500(Exception):
     code = 500
 
 class Page(object):
-    def __init__(self, modelAdmin, itemsPerPage = 20, currentPage = 1):
+    """Offset based paging for list view.
+        Page N is fetched with "LIMIT offset, n" so datastore walks through
+        all the items of preceding pages.
+    """
+    def __init__(self, modelAdmin, itemsPerPage = 20, currentPage = 1, listOptions = None):
         self.modelAdmin = modelAdmin
         self.model = self.modelAdmin.model
+        self.listOptions = listOptions
+        self.countProvider = self._getCountProvider()
         self.itemsPerPage = int(itemsPerPage)
         self.current = int(currentPage) # comes in as unicode
-        self.setPageNumbers()
+        self._fetchAndCount()
         logging.info("Paging: Maxpages: %r" % self.maxpages)
         logging.info("Paging: Current: %r" % self.current)
 
-    def setPageNumbers(self):
-        nItems = float(self.model.all().count())
+    def _getCountProvider(self):
+        """Filtered items are not counted, count provider counts all items.
+        """
+        if self.listOptions is not None and self.listOptions.active:
+            return counters.countProviders['none']
+        return self.modelAdmin.countProvider
+
+    def _fetchAndCount(self):
+        """Starts fetching items of current page and counts pages meanwhile.
+            Page query is sent before the count so that both run at once.
+            Fetch is started again if the requested page does not exist.
+        """
+        requested = self.current
+        self._results = self._startFetch()
+        self.setPageNumbers()
+        if self.current != requested:
+            self._results = self._startFetch()
+
+    def countMaxPages(self):
+        """Sets self.maxpages using count provider of ModelAdmin.
+            self.maxpages is None if total number of items is not known.
+        """
+        nItems = self.countProvider.count(self.modelAdmin)
         logging.info('Paging: Items per page: %s' % self.itemsPerPage)
-        logging.info('Paging: Number of items %s' % int(nItems))
-        self.maxpages = int(math.ceil(nItems / float(self.itemsPerPage)))
-        if self.maxpages < 1:
-            self.maxpages = 1
-        # validate current page number
-        if self.current > self.maxpages or self.current < 1:
-            self.current = 1
+        logging.info('Paging: Number of items %s' % nItems)
+        if nItems is None:
+            self.maxpages = None
+        else:
+            self.maxpages = int(math.ceil(float(nItems) / float(self.itemsPerPage)))
+            if self.maxpages < 1:
+                self.maxpages = 1
+
+    def setPageNumbers(self):
+        self.countMaxPages()
+        if self.countProvider.exact:
+            # validate current page number
+            if self.current > self.maxpages or self.current < 1:
+                self.current = 1
+        else:
+            # Approximate count is not good enough for validating page number.
+            if self.current < 1:
+                self.current = 1
+            if self.maxpages is not None:
+                self.maxpages = max(self.maxpages, self.current)
         if self.current > 1:
             self.prev = self.current - 1
         else:
             self.prev = None
-        if self.current < self.maxpages:
+        if self.countProvider.exact and self.current < self.maxpages:
             self.next = self.current + 1
         else:
+            # For approximate counts next page is found by iterDataForPage()
             self.next = None
         self.first = 1
         self.last = self.maxpages
 
-    def getDataForPage(self):
+    def _startFetch(self):
+        """Runs the query of current page. Query.run() sends the first
+            batch request right away and returns without waiting for it.
+        """
+        offset = int((self.current - 1) * self.itemsPerPage)
+        if self.countProvider.exact:
+            limit = ' LIMIT %i, %i' % (offset, self.itemsPerPage)
+        else:
+            # Fetch one extra item to find out if there is a next page
+            limit = ' LIMIT %i, %i' % (offset, self.itemsPerPage + 1)
+        logging.info("Paging: GQL: %s" % (self.modelAdmin.listGql + limit))
+        return self.modelAdmin.listQuery(limit, self.listOptions).run(batch_size = self.itemsPerPage + 1)
+
+    def iterDataForPage(self):
+        """Yields items of current page as the query returns them.
+            self.next is final when all items are yielded.
+        """
+        if self.countProvider.exact:
+            for item in self._results:
+                yield item
+            return
+        count = 0
+        for item in self._results:
+            if count == self.itemsPerPage:
+                self.next = self.current + 1
+                return
+            count += 1
+            yield item
+
+
+# Separates page number and cursors in CursorPage tokens.
+CURSOR_TOKEN_SEPARATOR = '.'
+
+class CursorPage(Page):
+    """Cursor based paging for list view.
+        Every page is fetched with a single query that starts at the cursor
+        carried in page token and asks for one item more than fits on the page
+        in order to find out if the next page exists.
+        Page token looks like "<page number>.<start cursor>.<earlier start cursors>"
+        where only the last admin_settings.ADMIN_CURSOR_TRAIL start cursors
+        are kept for "Previous" links. Plain page numbers are accepted too and
+        are fetched with an offset (this is used by "Last" link and by
+        pages that have fallen out of the cursor trail).
+    """
+    def __init__(self, modelAdmin, itemsPerPage = 20, currentPage = 1, listOptions = None):
+        self.modelAdmin = modelAdmin
+        self.model = self.modelAdmin.model
+        self.listOptions = listOptions
+        self.countProvider = self._getCountProvider()
+        self.itemsPerPage = int(itemsPerPage)
+        self.current, self.trail = self.parseToken(currentPage)
+        self._fetchAndCount()
+        logging.info("Paging: Maxpages: %r" % self.maxpages)
+        logging.info("Paging: Current: %r" % self.current)
+
+    @staticmethod
+    def parseToken(token):
+        """Returns (page number, start cursors) for given page token.
+            Start cursor list begins with the cursor of the page itself
+            and goes on with cursors of preceding pages.
+        """
+        try:
+            parts = str(token).split(CURSOR_TOKEN_SEPARATOR)
+            number = int(parts[0])
+        except (UnicodeError, ValueError):
+            return 1, []
+        if number <= 1:
+            return 1, []
+        return number, [cursor for cursor in parts[1:] if cursor]
+
+    @staticmethod
+    def makeToken(number, trail):
+        """Builds page token for page number and its start cursors.
+        """
+        if number <= 1:
+            return '1'
+        trail = trail[:admin_settings.ADMIN_CURSOR_TRAIL]
+        return CURSOR_TOKEN_SEPARATOR.join([str(number)] + trail)
+
+    def setPageNumbers(self):
+        self.countMaxPages()
+        # Page token is trusted over the count which might be out of date.
+        if self.maxpages is not None:
+            self.maxpages = max(self.maxpages, self.current)
+        if self.current > 1:
+            self.prev = self.makeToken(self.current - 1, self.trail[1:])
+        else:
+            self.prev = None
+        # Known only after the page is fetched by iterDataForPage()
+        self.next = None
+        self.first = 1
+        self.last = self.maxpages
+
+    def _startFetch(self):
+        """Returns (query, results) of current page query that is already sent.
+        """
+        query = self.modelAdmin.listQuery(listOptions = self.listOptions)
+        offset = 0
+        if self.trail:
+            try:
+                query.with_cursor(self.trail[0])
+            except datastore_errors.BadValueError:
+                raise Http404()
+        else:
+            offset = (self.current - 1) * self.itemsPerPage
+        logging.info("Paging: GQL: %s; offset: %i" % (self.modelAdmin.listGql, offset))
+        try:
+            results = query.run(offset = offset, limit = self.itemsPerPage + 1, batch_size = self.itemsPerPage + 1)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            raise Http404()
+        return query, results
+
+    def iterDataForPage(self):
+        query, results = self._results
+        count = 0
+        endCursor = None
+        while True:
+            try:
+                item = results.next()
+            except StopIteration:
+                return
+            except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+                # Cursor does not belong to this query (tampered or stale link)
+                raise Http404()
+            if count == self.itemsPerPage:
+                # The extra item only tells that there is a next page
+                self.next = self.makeToken(self.current + 1, [endCursor] + self.trail)
+                return
+            count += 1
+            if count == self.itemsPerPage:
+                # Cursor points right after the last item shown on this page
+                endCursor = query.cursor()
+            yield item
+
+
+class SearchPage(Page):
+    """Paging of full-text search results.
+        All matching keys are known in advance, items of current page
+        are fetched with one batched get.
+    """
+    def __init__(self, modelAdmin, itemsPerPage = 20, currentPage = 1, keys = ()):
+        self.keys = keys
+        super(SearchPage, self).__init__(modelAdmin, itemsPerPage, currentPage)
+
+    def _getCountProvider(self):
+        return counters.ListCount(self.keys)
+
+    def _startFetch(self):
         offset = int((self.current - 1) * self.itemsPerPage)
-        query = self.modelAdmin.listGql + ' LIMIT %i, %i' % (offset, self.itemsPerPage)
-        logging.info("Paging: GQL: %s" % query)
-        return self.model.gql(query)
+        keys = self.keys[offset:offset + self.itemsPerPage]
+        if not keys:
+            return None
+        return db.get_async(keys)
+
+    def iterDataForPage(self):
+        if self._results is None:
+            return
+        for item in self._results.get_result():
+            # Items deleted without admin site may be left in the index
+            if item is not None:
+                yield item
+
+
+# Page classes by ModelAdmin.listPaging value
+pageClasses = {
+    'offset': Page,
+    'cursor': CursorPage,
+}
@@ -1,35 +1,112 @@
 """Admin views"""
 
-import os.path
 import logging
-import re
 import copy
+import calendar
+import email.utils
+import hashlib
+import time
+import urllib
 
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.api import datastore_errors
-from google.appengine.ext.webapp import template
+from django.core.exceptions import ImproperlyConfigured
 
 import authorized
+import admin_forms
+import caching
+import dataexchange
+import db_extensions
+import instrumentation
+import list_options
+import search
 import utils
 import admin_settings
 import model_register
+import template_registry
 from .model_register import getModelAdmin
 from .utils import Http404, Http500
 
-ADMIN_TEMPLATE_DIR = admin_settings.ADMIN_TEMPLATE_DIR
 ADMIN_ITEMS_PER_PAGE = admin_settings.ADMIN_ITEMS_PER_PAGE
 
+# Placeholders of rows and paging in rendered list page
+LIST_ROWS_MARKER = '<!-- appengine_admin:rows -->'
+LIST_PAGING_MARKER = '<!-- appengine_admin:paging -->'
+
+# Compile frequently used templates once per process
+template_registry.preload()
+
+if admin_settings.ADMIN_STATS_ENABLED:
+    instrumentation.install()
+
 class BaseRequestHandler(webapp.RequestHandler):
     def handle_exception(self, exception, debug_mode):
         logging.warning("Exception catched: %r" % exception)
         if isinstance(exception, Http404) or isinstance(exception, Http500):
             self.error(exception.code)
-            path = os.path.join(ADMIN_TEMPLATE_DIR, str(exception.code) + ".html")
-            self.response.out.write(template.render(path, {'errorpage': True}).decode('UTF-8'))
+            template_registry.write(self.response.out, str(exception.code) + ".html", {'errorpage': True})
         else:
             super(BaseRequestHandler, self).handle_exception(exception, debug_mode)
 
 
+# Admin site URL scheme. Urls look like /ModelName/action/arg1/arg2/
+# and are mapped by action to the name of Admin class method and the
+# number of arguments that follow the action.
+# Start page (/) is mapped by None action.
+_getRoutes = {
+    None: ('index_get', 0),
+    'list': ('list_get', 0),
+    'new': ('new_get', 0),
+    'edit': ('edit_get', 1),
+    'delete': ('delete_get', 1),
+    'get_blob_contents': ('get_blob_contents', 2),
+    'export': ('export_get', 0),
+    'import': ('import_get', 0),
+    'lookup': ('lookup_get', 0),
+}
+_postRoutes = {
+    'new': ('new_post', 0),
+    'edit': ('edit_post', 1),
+    'delete_selected': ('delete_selected_post', 0),
+    'delete_all': ('delete_all_post', 0),
+    'bulk_edit': ('bulk_edit_post', 0),
+    'import': ('import_post', 0),
+    'rebuild_search_index': ('rebuild_search_index_post', 0),
+}
+# Site pages that do not belong to a model are mapped by full url
+# to the name of Admin class method that takes no arguments.
+_getSiteRoutes = {
+    '/_stats/': 'stats_get',
+    '/_stats/json/': 'stats_json_get',
+}
+_postSiteRoutes = {}
+
+def _resolve(url, routes, siteRoutes):
+    """Returns (method name, arguments) for given url from routes table
+        or site routes table.
+        Raises Http404 if url does not match any route.
+    """
+    if url in ('', '/'):
+        route = routes.get(None)
+        if route is None:
+            raise Http404()
+        return route[0], []
+    if url in siteRoutes:
+        return siteRoutes[url], []
+    parts = url.split('/')
+    # ['', 'ModelName', 'action', ..., '']
+    if len(parts) < 4 or parts[0] or parts[-1]:
+        raise Http404()
+    segments = parts[1:-1]
+    if '' in segments:
+        raise Http404()
+    route = routes.get(segments[1])
+    if route is None or route[1] != len(segments) - 2:
+        raise Http404()
+    return route[0], [segments[0]] + segments[2:]
+
+
 class Admin(BaseRequestHandler):
     """Use this class as view in your URL scheme definitions.
         Example:
@@ -58,65 +135,45 @@ class Admin(BaseRequestHandler):
             super(Admin, self).__init__()
         else:
             super(Admin, self).__init__(request, response)
-        logging.info("NEW Admin object created")
-        # Define and compile regexps for Admin site URL scheme.
-        # Every URL will be mapped to appropriate method of this
-        # class that handles all requests of particular HTTP message
-        # type (GET or POST).
-        self.getRegexps = [
-            [r'^/?$', self.index_get],
-            [r'^/([^/]+)/list/$', self.list_get],
-            [r'^/([^/]+)/new/$', self.new_get],
-            [r'^/([^/]+)/edit/([^/]+)/$', self.edit_get],
-            [r'^/([^/]+)/delete/([^/]+)/$', self.delete_get],
-            [r'^/([^/]+)/get_blob_contents/([^/]+)/([^/]+)/$', self.get_blob_contents],
-        ]
-        self.postRegexps = [
-            [r'^/([^/]+)/new/$', self.new_post],
-            [r'^/([^/]+)/edit/([^/]+)/$', self.edit_post],
-        ]
-        self._compileRegexps(self.getRegexps)
-        self._compileRegexps(self.postRegexps)
         # Store ordered list of registered data models.
-        self.models = model_register._modelRegister.keys()
-        self.models.sort()
+        self.models = model_register.getModelNames()
         # This variable is set by get and port methods and used later
         # for constructing new admin urls.
         self.urlPrefix = ''
 
-    def _compileRegexps(self, regexps):
-        """Compiles all regular expressions in regexps list
-        """
-        for i in range(len(regexps)):
-            regexps[i][0] = re.compile(regexps[i][0])
-
     def get(self, urlPrefix, url):
         """Handle HTTP GET
         """
         self.urlPrefix = urlPrefix
-        self._callHandlingMethod(url, self.getRegexps)
+        self._callHandlingMethod(url, _getRoutes, _getSiteRoutes)
 
     def post(self, urlPrefix, url):
         """Handle HTTP POST
         """
         self.urlPrefix = urlPrefix
-        self._callHandlingMethod(url, self.postRegexps)
+        self._callHandlingMethod(url, _postRoutes, _postSiteRoutes)
 
-    def _callHandlingMethod(self, url, regexps):
-        """Tries matching given url by searching in list of compiled
-            regular expressions. Calls method that has been mapped
-            to matched regular expression or raises Http404 exception.
+    def _callHandlingMethod(self, url, routes, siteRoutes):
+        """Finds the method that handles given url in routes table
+            and calls it or raises Http404 exception.
             Url example: /ModelName/edit/kasdkjlkjaldkj/
         """
-        for regexp, function in regexps:
-            matched = regexp.match(url)
-            logging.info("Url: %s" % str(url))
-            logging.info("regex: %s" % str(regexp))
-            if matched:
-                function(*matched.groups())
+        methodName, args = _resolve(url, routes, siteRoutes)
+        if admin_settings.ADMIN_TRACE_ROUTING:
+            logging.info("Url %s routed to %s%r" % (url, methodName, tuple(args)))
+        # Values are cached for this request only
+        caching.startRequest()
+        try:
+            if not admin_settings.ADMIN_STATS_ENABLED:
+                getattr(self, methodName)(*args)
                 return
-        # raise http error 404 (not found) if no match
-        raise Http404()
+            instrumentation.startRequest(methodName)
+            try:
+                getattr(self, methodName)(*args)
+            finally:
+                instrumentation.finishRequest()
+        finally:
+            caching.finishRequest()
 
     @staticmethod
     def _safeGetItem(model, key):
@@ -137,7 +194,7 @@ class Admin(BaseRequestHandler):
         for i in range(len(readonlyProperties)):
             itemValue = getattr(item, readonlyProperties[i].name)
             readonlyProperties[i].value = itemValue
-            if readonlyProperties[i].typeName == 'BlobProperty':
+            if readonlyProperties[i].isBlob:
                 logging.info("%s :: Binary content" % readonlyProperties[i].name)
                 readonlyProperties[i].meta = utils.getBlobProperties(item, readonlyProperties[i].name)
                 if readonlyProperties[i].value:
@@ -151,33 +208,200 @@ class Admin(BaseRequestHandler):
     def index_get(self):
         """Show admin start page
         """
-        path = os.path.join(ADMIN_TEMPLATE_DIR, 'index.html')
-        self.response.out.write(template.render(path, {
+        template_registry.write(self.response.out, 'index.html', {
             'models': self.models,
             'urlPrefix': self.urlPrefix,
-        }).decode('UTF-8'))
+        })
+
+    @authorized.role("admin")
+    def stats_get(self):
+        """Show datastore RPC and timing percentiles of admin requests per route.
+        """
+        summary = instrumentation.summary()
+        routes = []
+        for route in sorted(summary.keys()):
+            values = dict(summary[route])
+            values['route'] = route
+            # RPC columns in the order of table header
+            values['rpcs'] = [values['rpcs'].get(kind) for kind in instrumentation.RPC_KINDS]
+            routes.append(values)
+        template_registry.write(self.response.out, 'stats.html', {
+            'models': self.models,
+            'urlPrefix': self.urlPrefix,
+            'routes': routes,
+            'rpcKinds': instrumentation.RPC_KINDS,
+            'window': admin_settings.ADMIN_STATS_WINDOW,
+            'enabled': admin_settings.ADMIN_STATS_ENABLED,
+        })
+
+    @authorized.role("admin")
+    def stats_json_get(self):
+        """Return the summary shown on stats page as JSON object.
+        """
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.out.write(dataexchange.json.dumps(instrumentation.summary()))
 
     @authorized.role("admin")
     def list_get(self, modelName):
         """Show list of records for particular model
         """
         modelAdmin = getModelAdmin(modelName)
-        path = os.path.join(ADMIN_TEMPLATE_DIR, 'model_item_list.html')
-        page = utils.Page(
-                modelAdmin = modelAdmin,
-                itemsPerPage = ADMIN_ITEMS_PER_PAGE,
-                currentPage = self.request.get('page', 1)
-            )
-        # Get only those items that should be displayed in current page
-        items = page.getDataForPage()
-        self.response.out.write(template.render(path, {
+        # Filters are validated before anything is written
+        listOptions = list_options.ListOptions(modelAdmin, self.request)
+        searchText = modelAdmin.searchFields and self.request.get('q', '').strip() or ''
+        if searchText:
+            queryString = urllib.urlencode([('q', searchText.encode('utf-8'))]) + '&'
+        else:
+            queryString = listOptions.queryString()
+        fragments = None
+        if modelAdmin.listCache:
+            cacheName = self._listCacheName(modelAdmin)
+            fragments = caching.getValue(modelAdmin.modelName, cacheName)
+        if fragments is None:
+            # Page query is sent before the page is rendered
+            # and its results are read while rows are rendered.
+            if searchText:
+                # Filters and sort order do not apply to search results
+                page = utils.SearchPage(
+                    modelAdmin = modelAdmin,
+                    itemsPerPage = ADMIN_ITEMS_PER_PAGE,
+                    currentPage = self.request.get('page', 1),
+                    keys = search.search(modelAdmin.modelName, searchText)
+                )
+            else:
+                page = utils.pageClasses[modelAdmin.listPaging](
+                    modelAdmin = modelAdmin,
+                    itemsPerPage = ADMIN_ITEMS_PER_PAGE,
+                    currentPage = self.request.get('page', 1),
+                    listOptions = listOptions
+                )
+            # References of the first rows are fetched while the page is rendered
+            items = modelAdmin.iterListFields(page.iterDataForPage())
+        # Page around the rows and paging is rendered first,
+        # rows are rendered one by one as the query returns items.
+        html = template_registry.render('model_item_list.html', {
             'models': self.models,
             'urlPrefix': self.urlPrefix,
             'moduleTitle': modelAdmin.modelName,
-            'listProperties': modelAdmin._listProperties,
-            'items': map(modelAdmin._attachListFields, items),
-            'page': page,
-        }).decode('UTF-8'))
+            'listColumns': listOptions.columns(),
+            'bulkEditProperties': modelAdmin._bulkEditProperties,
+            'listFilters': listOptions.filters,
+            'sort': listOptions.sort,
+            'searchFields': modelAdmin.searchFields,
+            'searchText': searchText,
+            'filterQueryString': listOptions.filterQueryString(),
+            'filterErrors': listOptions.errors,
+            # Actions on all items ignore filters and search
+            'listNarrowed': listOptions.active or bool(searchText),
+            'listRows': LIST_ROWS_MARKER,
+            'listPaging': LIST_PAGING_MARKER,
+        })
+        if html.count(LIST_ROWS_MARKER) != 1 or html.count(LIST_PAGING_MARKER) != 1:
+            raise ImproperlyConfigured(
+                "Template model_item_list.html in %s must output {{ listRows }} and {{ listPaging }} once each"
+                % admin_settings.ADMIN_TEMPLATE_DIR)
+        rowsFirst = html.index(LIST_ROWS_MARKER) < html.index(LIST_PAGING_MARKER)
+        if rowsFirst:
+            head, rest = html.split(LIST_ROWS_MARKER)
+            middle, tail = rest.split(LIST_PAGING_MARKER)
+        else:
+            head, rest = html.split(LIST_PAGING_MARKER)
+            middle, tail = rest.split(LIST_ROWS_MARKER)
+        out = self.response.out
+        out.write(head)
+        rowsWritten = False
+        if fragments is None:
+            rows = []
+            rowValues = {
+                'urlPrefix': self.urlPrefix,
+                'moduleTitle': modelAdmin.modelName,
+            }
+            for item in items:
+                rowValues['item'] = item
+                row = template_registry.render('model_item_list_row.html', rowValues)
+                if rowsFirst:
+                    # Paging placed above the rows is known only after all of them
+                    out.write(row)
+                rows.append(row)
+            rowsWritten = rowsFirst
+            # Next page is known when all items are read
+            paging = template_registry.render('model_item_list_paging.html', {
+                'page': page,
+                'queryString': queryString,
+            })
+            fragments = {'rows': ''.join(rows), 'paging': paging}
+            if modelAdmin.listCache:
+                if len(fragments['rows']) + len(paging) <= admin_settings.ADMIN_LIST_CACHE_MAX_SIZE:
+                    caching.setValue(modelAdmin.modelName, cacheName, fragments, cacheTime = modelAdmin.listCache)
+        if rowsFirst:
+            if not rowsWritten:
+                out.write(fragments['rows'])
+            out.write(middle)
+            out.write(fragments['paging'])
+        else:
+            out.write(fragments['paging'])
+            out.write(middle)
+            out.write(fragments['rows'])
+        out.write(tail)
+
+    def _listCacheName(self, modelAdmin):
+        """Returns name of list page fragments in cache.
+            Name depends on all query parameters, url prefix used in links
+            and generations of models referenced by list fields whose
+            labels are shown in the rows.
+        """
+        options = sorted(self.request.GET.items())
+        referenced = sorted(set([
+            prop.prop.reference_class.kind()
+            for prop in modelAdmin._listProperties
+            if prop.typeName in ('ReferenceProperty', 'ManyToManyProperty')
+        ]))
+        generations = [(kind, caching.getGeneration(kind)) for kind in referenced]
+        return 'list:%s' % hashlib.md5(repr((self.urlPrefix, options, generations))).hexdigest()
+
+    @authorized.role("admin")
+    def export_get(self, modelName):
+        """Export all records of particular model matched by listGql.
+            Request parameters:
+            format - 'csv' (default) or 'jsonl' (JSON object per line)
+            fields - 'list' (default) for listFields or 'all' for all properties
+        """
+        modelAdmin = getModelAdmin(modelName)
+        fileFormat = self.request.get('format', 'csv')
+        if fileFormat not in dataexchange.FORMATS:
+            raise Http404()
+        contentType, extension = dataexchange.FORMATS[fileFormat]
+        self.response.headers['Content-Type'] = contentType
+        self.response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (modelAdmin.modelName, extension)
+        allFields = self.request.get('fields') == 'all'
+        for row in dataexchange.exportRows(modelAdmin, allFields, fileFormat):
+            self.response.out.write(row)
+
+    @authorized.role("admin")
+    def lookup_get(self, modelName):
+        """Search items that can be referenced by lazy loading reference field
+            of particular model (see ModelAdmin.lookupFields).
+            Request parameters:
+            field - name of reference field
+            q - prefix of item label property
+            cursor - cursor returned by previous request for more items
+            Returns JSON object {"items": [[key, label], ...], "cursor": cursor or null}.
+        """
+        modelAdmin = getModelAdmin(modelName)
+        query = modelAdmin.getLookupQuery(self.request.get('field'), self.request.get('q'))
+        cursor = self.request.get('cursor')
+        limit = admin_settings.ADMIN_LOOKUP_LIMIT
+        try:
+            if cursor:
+                query.with_cursor(cursor)
+            items = query.fetch(limit)
+        except (datastore_errors.BadRequestError, datastore_errors.BadValueError):
+            raise Http404()
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.out.write(dataexchange.json.dumps({
+            'items': [[str(item.key()), unicode(item)] for item in items],
+            'cursor': len(items) == limit and query.cursor() or None,
+        }))
 
     @authorized.role("admin")
     def new_get(self, modelName):
@@ -193,8 +417,7 @@ class Admin(BaseRequestHandler):
             'editForm': modelAdmin.AdminForm(urlPrefix = self.urlPrefix),
             'readonlyProperties': modelAdmin._readonlyProperties,
         }
-        path = os.path.join(ADMIN_TEMPLATE_DIR, 'model_item_edit.html')
-        self.response.out.write(template.render(path, templateValues).decode('UTF-8'))
+        template_registry.write(self.response.out, 'model_item_edit.html', templateValues)
 
     @authorized.role("admin")
     def new_post(self, modelName):
@@ -205,6 +428,8 @@ class Admin(BaseRequestHandler):
         if form.is_valid():
         # Save the data, and redirect to the edit page
             item = form.save()
+            modelAdmin.countProvider.change(modelAdmin, 1)
+            caching.bumpGeneration(modelAdmin.modelName)
             self.redirect("%s/%s/edit/%s/" % (self.urlPrefix, modelAdmin.modelName, item.key()))
         else:
             # Display errors with entered values
@@ -216,8 +441,7 @@ class Admin(BaseRequestHandler):
                 'editForm': form,
                 'readonlyProperties': modelAdmin._readonlyProperties,
             }
-            path = os.path.join(ADMIN_TEMPLATE_DIR, 'model_item_edit.html')
-            self.response.out.write(template.render(path, templateValues).decode('UTF-8'))
+            template_registry.write(self.response.out, 'model_item_edit.html', templateValues)
 
     @authorized.role("admin")
     def edit_get(self, modelName, key = None):
@@ -234,8 +458,7 @@ class Admin(BaseRequestHandler):
             'editForm': modelAdmin.AdminForm(urlPrefix = self.urlPrefix, instance = item),
             'readonlyProperties': self._readonlyPropsWithValues(item, modelAdmin),
         }
-        path = os.path.join(ADMIN_TEMPLATE_DIR, 'model_item_edit.html')
-        self.response.out.write(template.render(path, templateValues).decode('UTF-8'))
+        template_registry.write(self.response.out, 'model_item_edit.html', templateValues)
 
     @authorized.role("admin")
     def edit_post(self, modelName, key):
@@ -248,6 +471,8 @@ class Admin(BaseRequestHandler):
         if form.is_valid():
         # Save the data, and redirect to the edit page
             item = form.save()
+            utils.forgetBlobProperties(item)
+            caching.bumpGeneration(modelAdmin.modelName)
             self.redirect("%s/%s/edit/%s/" % (self.urlPrefix, modelAdmin.modelName, item.key()))
         else:
             templateValues = {
@@ -258,8 +483,7 @@ class Admin(BaseRequestHandler):
                 'editForm': form,
                 'readonlyProperties': self._readonlyPropsWithValues(item, modelAdmin),
             }
-            path = os.path.join(ADMIN_TEMPLATE_DIR, 'model_item_edit.html')
-            self.response.out.write(template.render(path, templateValues).decode('UTF-8'))
+            template_registry.write(self.response.out, 'model_item_edit.html', templateValues)
 
 
     @authorized.role("admin")
@@ -269,24 +493,386 @@ class Admin(BaseRequestHandler):
         """
         modelAdmin = getModelAdmin(modelName)
         item = self._safeGetItem(modelAdmin.model, key)
-        item.delete()
+        self._deleteKeys(modelAdmin, [item.key()], [item])
         self.redirect("%s/%s/list/" % (self.urlPrefix, modelAdmin.modelName))
 
+    @staticmethod
+    def _deleteKeys(modelAdmin, keys, items = None):
+        """Deletes items of particular model by keys with a single datastore call
+            and updates everything that depends on them.
+            items - already loaded entities if any. Entities are loaded only if
+            the model has ChunkedBlobProperty fields whose chunks must be deleted
+            or if the count provider must be told how many items existed.
+        """
+        if items is None and (modelAdmin.hasChunkedBlobs or modelAdmin.countProvider.tracksChanges):
+            items = [item for item in db.get(keys) if item is not None]
+        for item in items or []:
+            db_extensions.deleteItemBlobChunks(item)
+        if modelAdmin.searchFields:
+            # Unindexed first: failure leaves items in place, not their postings
+            search.unindexKeys(keys)
+        db.delete(keys)
+        utils.forgetBlobPropertiesByKeys(modelAdmin.model, keys)
+        nDeleted = len(keys)
+        if items is not None:
+            # Keys of items that no longer exist are not counted
+            nDeleted = len(items)
+        modelAdmin.countProvider.change(modelAdmin, -nDeleted)
+        caching.bumpGeneration(modelAdmin.modelName)
+
+    def _getPostedKeys(self, modelAdmin):
+        """Returns keys of particular model selected in list view.
+            Malformed keys and keys of other models are ignored.
+        """
+        keys = []
+        for key in self.request.get_all('key'):
+            try:
+                key = db.Key(key)
+            except (datastore_errors.BadKeyError, datastore_errors.BadArgumentError, UnicodeError):
+                continue
+            if key.kind() == modelAdmin.modelName:
+                keys.append(key)
+        return keys
+
+    @authorized.role("admin")
+    def delete_selected_post(self, modelName):
+        """Delete records of particular model selected in list view.
+        """
+        modelAdmin = getModelAdmin(modelName)
+        keys = self._getPostedKeys(modelAdmin)
+        for start in range(0, len(keys), admin_settings.ADMIN_BULK_BATCH_SIZE):
+            self._deleteKeys(modelAdmin, keys[start:start + admin_settings.ADMIN_BULK_BATCH_SIZE])
+        self.redirect("%s/%s/list/" % (self.urlPrefix, modelAdmin.modelName))
+
+    @authorized.role("admin")
+    def delete_all_post(self, modelName):
+        """Delete all records of particular model matched by listGql.
+            Keys are fetched with keys-only queries and deleted in batches.
+        """
+        modelAdmin = getModelAdmin(modelName)
+        def deleteBatch(keys):
+            self._deleteKeys(modelAdmin, keys)
+            return 'deleted %i items' % len(keys)
+        self._runBulkAction(modelAdmin, 'Delete all', deleteBatch)
+
+    @authorized.role("admin")
+    def bulk_edit_post(self, modelName):
+        """Set value of one field for records selected in list view
+            or for all records matched by listGql.
+            First post from list view shows the input for the field value.
+            The value is validated once by AdminForm field and then applied
+            in batched get/put cycles.
+        """
+        modelAdmin = getModelAdmin(modelName)
+        fieldName = self.request.get('field')
+        properties = [prop for prop in modelAdmin._bulkEditProperties if prop.name == fieldName]
+        if not properties:
+            raise Http404()
+        allItems = bool(self.request.get('all'))
+        keys = self._getPostedKeys(modelAdmin)
+        errors = None
+        if self.request.get('apply'):
+            form = modelAdmin.AdminForm(urlPrefix = self.urlPrefix, data = self.request.POST)
+            field = form.fields[fieldName]
+            try:
+                value = field.clean(field.widget.value_from_datadict(self.request.POST, None, form.add_prefix(fieldName)))
+            except admin_forms.ValidationError, exc:
+                errors = exc.messages
+            else:
+                value = getattr(modelAdmin.model, fieldName).make_value_from_form(value)
+                def updateBatch(batchKeys):
+                    items = [item for item in db.get(batchKeys) if item is not None]
+                    for item in items:
+                        setattr(item, fieldName, value)
+                    db.put(items)
+                    if fieldName in modelAdmin.searchFields:
+                        search.indexItems(modelAdmin.searchFields, items)
+                    caching.bumpGeneration(modelAdmin.modelName)
+                    return 'updated %i items, %i not found' % (len(items), len(batchKeys) - len(items))
+                if allItems:
+                    # walk all items matched by listGql
+                    keys = None
+                self._runBulkAction(modelAdmin, 'Set %s' % properties[0].verbose_name, updateBatch, keys)
+                return
+        else:
+            form = modelAdmin.AdminForm(urlPrefix = self.urlPrefix)
+        template_registry.write(self.response.out, 'model_item_bulk_edit.html', {
+            'models': self.models,
+            'urlPrefix': self.urlPrefix,
+            'moduleTitle': modelAdmin.modelName,
+            'property': properties[0],
+            'fieldHtml': unicode(form[fieldName]),
+            'errors': errors,
+            'allItems': allItems,
+            'keys': keys,
+            'enctype': form.enctype,
+        })
+
+    @authorized.role("admin")
+    def rebuild_search_index_post(self, modelName):
+        """Index all records of particular model for full-text search.
+            Used for records saved before searchFields were set or changed.
+        """
+        modelAdmin = getModelAdmin(modelName)
+        if not modelAdmin.searchFields:
+            raise Http404()
+        def indexBatch(keys):
+            indexed = search.rebuildIndex(modelAdmin.searchFields, keys)
+            # Cached search result pages are stale now
+            caching.bumpGeneration(modelAdmin.modelName)
+            return 'indexed %i items' % indexed
+        self._runBulkAction(modelAdmin, 'Rebuild search index', indexBatch,
+            keysQuery = lambda: modelAdmin.model.all(keys_only = True))
+
+    def _runBulkAction(self, modelAdmin, actionTitle, action, keys = None, keysQuery = None):
+        """Applies action to batches of item keys and shows per batch results.
+            action(keys) returns description of the batch result.
+            keys - keys of selected items or None for all items matched by listGql.
+            keysQuery - function returning keys-only query for walking other
+            items than those matched by listGql.
+            All items are walked with keys-only queries. When request time limit
+            is reached the progress page posts the request back with the query
+            cursor to continue in a new request.
+        """
+        batchSize = admin_settings.ADMIN_BULK_BATCH_SIZE
+        total = int(self.request.get('total', 0))
+        batches = []
+        continueFields = None
+
+        def runBatch(batchKeys):
+            try:
+                result = action(batchKeys)
+            except datastore_errors.Error, exc:
+                logging.warning('Error catched in bulk action %s: %s' % (actionTitle, exc))
+                result = 'failed (%s)' % exc
+            batches.append('Batch %i: %s' % (len(batches) + 1, result))
+
+        if keys is not None:
+            for start in range(0, len(keys), batchSize):
+                runBatch(keys[start:start + batchSize])
+                total += len(keys[start:start + batchSize])
+        else:
+            deadline = time.time() + admin_settings.ADMIN_BULK_TIME_LIMIT
+            cursor = self.request.get('cursor', None)
+            while True:
+                if time.time() >= deadline:
+                    continueFields = [(name, value) for name, value in self.request.POST.items()
+                        if name not in ('cursor', 'total')]
+                    continueFields += [('cursor', cursor), ('total', total)]
+                    break
+                query = (keysQuery or modelAdmin.listKeysQuery)()
+                if cursor:
+                    query.with_cursor(cursor)
+                batchKeys = query.fetch(batchSize)
+                if not batchKeys:
+                    break
+                cursor = query.cursor()
+                runBatch(batchKeys)
+                total += len(batchKeys)
+        self._renderBulkProgress(modelAdmin, actionTitle, batches,
+            '%i items processed' % total, continueFields)
+
+    def _renderBulkProgress(self, modelAdmin, actionTitle, batches, summary, continueFields = None, errors = None):
+        """Shows per batch results of a bulk action.
+            continueFields - (name, value) pairs posted back to the same url
+            to continue the action in a new request.
+            errors - list of (row number, field, message) tuples
+        """
+        template_registry.write(self.response.out, 'model_item_bulk.html', {
+            'models': self.models,
+            'urlPrefix': self.urlPrefix,
+            'moduleTitle': modelAdmin.modelName,
+            'actionTitle': actionTitle,
+            'batches': batches,
+            'summary': summary,
+            'continueFields': continueFields,
+            'errors': errors,
+        })
+
+    @authorized.role("admin")
+    def import_get(self, modelName):
+        """Show form for importing records of particular model from CSV or JSON lines file.
+        """
+        modelAdmin = getModelAdmin(modelName)
+        template_registry.write(self.response.out, 'model_item_import.html', {
+            'models': self.models,
+            'urlPrefix': self.urlPrefix,
+            'moduleTitle': modelAdmin.modelName,
+            'formats': sorted(dataexchange.FORMATS.keys()),
+        })
+
+    @authorized.role("admin")
+    def import_post(self, modelName):
+        """Import records of particular model from uploaded CSV or JSON lines file.
+            Rows are validated with AdminForm and valid ones are written with
+            one db.put per admin_settings.ADMIN_IMPORT_BATCH_SIZE rows.
+            Uploaded file is stored in blob chunks first so that import can be
+            continued in new requests when request time limit is reached.
+        """
+        modelAdmin = getModelAdmin(modelName)
+        deadline = time.time() + admin_settings.ADMIN_BULK_TIME_LIMIT
+        fileFormat = self.request.get('format')
+        blobId = self.request.get('blob')
+        if blobId:
+            chunkCount = int(self.request.get('chunks'))
+        else:
+            upload = self.request.POST.get('file')
+            if getattr(upload, 'file', None) is None:
+                raise Http404()
+            if fileFormat not in dataexchange.FORMATS:
+                fileFormat = upload.filename.rsplit('.', 1)[-1].lower()
+            upload.file.seek(0, 2)
+            storedFile = admin_forms.ChunkedUpload(upload.file, upload.file.tell())
+            blobId = storedFile.blobId
+            chunkCount = db_extensions.putBlobChunks(blobId, storedFile.chunks())
+        if fileFormat not in dataexchange.FORMATS:
+            fileFormat = 'csv'
+        dryRun = bool(self.request.get('dry_run'))
+        importer = dataexchange.Importer(modelAdmin, dryRun, bool(self.request.get('ignore_keys')))
+        importer.created = int(self.request.get('created', 0))
+        importer.updated = int(self.request.get('updated', 0))
+        importer.failed = int(self.request.get('failed', 0))
+        importer.errors = [tuple(error) for error in dataexchange.json.loads(self.request.get('errors', '[]'))]
+        done = int(self.request.get('rows', 0))
+        rows = dataexchange.readRows(
+            dataexchange.iterLines(db_extensions.readBlobChunks(blobId, 0, chunkCount - 1)), fileFormat)
+        batches = []
+        batch = []
+        rowNumber = 0
+        finished = True
+        for row, error in rows:
+            rowNumber += 1
+            if rowNumber <= done:
+                # imported by preceding requests
+                continue
+            batch.append((rowNumber, row, error))
+            if len(batch) == admin_settings.ADMIN_IMPORT_BATCH_SIZE:
+                self._importBatch(importer, batch, batches)
+                batch = []
+                if time.time() >= deadline:
+                    finished = False
+                    break
+        if batch:
+            self._importBatch(importer, batch, batches)
+        summary = '%s%i items created, %i updated, %i rows failed' % (
+            dryRun and 'Dry run: ' or '', importer.created, importer.updated, importer.failed)
+        continueFields = None
+        if finished:
+            db_extensions.deleteBlobChunks(blobId)
+        else:
+            continueFields = [
+                ('blob', blobId), ('chunks', chunkCount), ('format', fileFormat),
+                ('dry_run', dryRun and '1' or ''), ('ignore_keys', importer.ignoreKeys and '1' or ''),
+                ('rows', rowNumber), ('created', importer.created), ('updated', importer.updated),
+                ('failed', importer.failed), ('errors', dataexchange.json.dumps(importer.errors)),
+            ]
+        self._renderBulkProgress(modelAdmin, 'Import', batches, summary, continueFields, importer.errors)
+
+    @staticmethod
+    def _importBatch(importer, batch, batches):
+        failed = importer.failed
+        importer.importBatch(batch)
+        batches.append('Rows %i-%i: %i imported, %i failed' % (
+            batch[0][0], batch[-1][0], len(batch) - (importer.failed - failed), importer.failed - failed))
+
     @authorized.role("admin")
     def get_blob_contents(self, modelName, fieldName, key):
         """Returns blob field contents to user for downloading.
+            Supports conditional GET (ETag, Last-Modified) and single range requests.
+            Revalidation is answered from cached meta info without loading the blob.
         """
         modelAdmin = getModelAdmin(modelName)
+        props = utils.getCachedBlobProperties(key, fieldName)
+        if props and self._blobNotModified(props):
+            self._setBlobCacheHeaders(props)
+            self.response.set_status(304)
+            return
         item = self._safeGetItem(modelAdmin.model, key)
         data = getattr(item, fieldName, None)
         if data is None:
             raise Http404()
-        else:
-            props = utils.getBlobProperties(item, fieldName)
-            if props:
-                self.response.headers['Content-Type'] = props['Content_Type']
-                self.response.headers['Content-Disposition'] = 'inline; filename=%s' % props['File_Name']
-                logging.info("Setting content type to %s" % props['Content_Type'])
+        chunked = isinstance(modelAdmin.model.properties().get(fieldName), db_extensions.ChunkedBlobProperty)
+        props = utils.getBlobProperties(item, fieldName) or {}
+        if chunked and 'Chunk_Count' not in props:
+            # Chunked blob without meta info field
+            props['Chunk_Count'], props['Chunk_Size'], props['File_Size'] = db_extensions.getBlobChunkInfo(data)
+        if 'Content_Hash' not in props:
+            if chunked:
+                # Chunks of a blob id never change
+                props['Content_Hash'] = data
             else:
-                self.response.headers['Content-Type'] = 'application/octet-stream'
+                # Meta info saved before content hashes were introduced
+                props['Content_Hash'] = utils.blobHash(data)
+        utils.cacheBlobProperties(item.key(), fieldName, props)
+        self._setBlobCacheHeaders(props)
+        if self._blobNotModified(props):
+            self.response.set_status(304)
+            return
+        if 'Content_Type' in props:
+            self.response.headers['Content-Type'] = props['Content_Type']
+            self.response.headers['Content-Disposition'] = 'inline; filename=%s' % props['File_Name']
+            logging.info("Setting content type to %s" % props['Content_Type'])
+        else:
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+        if chunked:
+            size = props['File_Size']
+        else:
+            size = len(data)
+        byteRange = None
+        rangeHeader = self.request.headers.get('Range')
+        ifRange = self.request.headers.get('If-Range')
+        if rangeHeader and (not ifRange or ifRange == self.response.headers['ETag']):
+            try:
+                byteRange = utils.parseByteRange(rangeHeader, size)
+            except utils.RangeNotSatisfiable:
+                self.response.set_status(416)
+                self.response.headers['Content-Range'] = 'bytes */%i' % size
+                return
+        if byteRange:
+            first, last = byteRange
+            self.response.set_status(206)
+            self.response.headers['Content-Range'] = 'bytes %i-%i/%i' % (first, last, size)
+        else:
+            first, last = 0, size - 1
+        if chunked:
+            self._writeBlobChunks(data, props['Chunk_Size'], first, last)
+        elif byteRange:
+            self.response.out.write(data[first:last + 1])
+        else:
             self.response.out.write(data)
+
+    def _writeBlobChunks(self, blobId, chunkSize, first, last):
+        """Writes bytes from first to last (inclusive) of chunked blob
+            reading only the chunks that contain them.
+        """
+        if last < first:
+            return
+        position = (first // chunkSize) * chunkSize
+        for chunk in db_extensions.readBlobChunks(blobId, first // chunkSize, last // chunkSize):
+            self.response.out.write(chunk[max(first - position, 0):last + 1 - position])
+            position += len(chunk)
+
+    def _setBlobCacheHeaders(self, props):
+        self.response.headers['ETag'] = '"%s"' % props['Content_Hash']
+        self.response.headers['Cache-Control'] = admin_settings.ADMIN_BLOB_CACHE_CONTROL
+        self.response.headers['Accept-Ranges'] = 'bytes'
+        if props.get('Upload_Date'):
+            self.response.headers['Last-Modified'] = email.utils.formatdate(
+                calendar.timegm(props['Upload_Date'].utctimetuple()), usegmt = True)
+
+    def _blobNotModified(self, props):
+        """Checks If-None-Match and If-Modified-Since request headers against blob meta info.
+        """
+        ifNoneMatch = self.request.headers.get('If-None-Match')
+        if ifNoneMatch:
+            etags = [etag.strip() for etag in ifNoneMatch.split(',')]
+            # If-None-Match uses weak comparison
+            etags = [etag[2:] if etag.startswith('W/') else etag for etag in etags]
+            return '*' in etags or ('"%s"' % props['Content_Hash']) in etags
+        ifModifiedSince = self.request.headers.get('If-Modified-Since')
+        if ifModifiedSince and props.get('Upload_Date'):
+            since = email.utils.parsedate_tz(ifModifiedSince)
+            if since:
+                uploaded = calendar.timegm(props['Upload_Date'].utctimetuple())
+                return uploaded <= email.utils.mktime_tz(since)
+        return False